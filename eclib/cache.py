@@ -0,0 +1,315 @@
+import os
+import json
+import hashlib
+import shutil
+import pandas as pd
+import numpy as np
+
+def cache_key(file, variables=None):
+    '''
+    Формирует ключ кэша для файла 'file' по его полному пути, размеру, времени модификации и списку переменных 'variables'.
+    
+    Parameters
+    ----------
+    file : str
+        Полное имя исходного файла.
+    variables : list of str; optional
+        Список считываемых переменных.
+        Default: None
+    
+    Returns
+    -------
+    key : str
+        Шестнадцатеричная строка, однозначно соответствующая версии файла.
+    '''
+    
+    stat = os.stat(file)
+    source = f'{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}|{sorted(variables) if variables else None}'
+    key = hashlib.sha1(source.encode()).hexdigest()
+    
+    return key
+
+
+
+def write_cache(df, cache_path, source=None, codec=None, resolution=0.01, variables=None):
+    '''
+    Записывает 'df' в кэш 'cache_path' в колоночном бинарном формате.
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Датафрейм с индексом pd.DatetimeIndex и числовыми колонками.
+    cache_path : str
+        Путь к папке кэша одного файла.
+    source : str; optional
+        Полное имя исходного файла, сохраняется в метаданных.
+        Default: None
+    codec : {None, 'int16'}; optional
+        Кодек хранения колонок. None - float64 без потерь, 'int16' - квантование с шагом 'resolution' (см. encode_int16), 
+        2 байта на значение на диске вместо 8. При считывании колонки декодируются в float64 (см. read_cache).
+        Default: None
+    resolution : float or dict; optional
+        Шаг квантования для codec='int16', одно значение для всех колонок или словарь {колонка: шаг}.
+        Default: 0.01
+    variables : list of str; optional
+        Список переменных, с которым считывался исходный файл, сохраняется в метаданных для проверки ключа (см. clean_cache).
+        Default: None
+    
+    Каждая колонка и индекс сохраняются в отдельный .npy файл, что позволяет считывать их через np.memmap.
+    Запись атомарная: данные пишутся во временную папку, которая затем переименовывается в 'cache_path'.
+    '''
+    
+    tmp_path = f'{cache_path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    np.save(os.path.join(tmp_path, 'index.npy'), df.index.values)
+
+    meta = {'source': source, 'variables': list(variables) if variables is not None else None, 
+            'columns': [str(column) for column in df.columns], 'codec': codec, 'scale': [], 'offset': []}
+
+    for i, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        if codec == 'int16':
+            step = resolution[column] if isinstance(resolution, dict) else resolution
+            values, scale, offset = encode_int16(values, step)
+            meta['scale'].append(scale)
+            meta['offset'].append(offset)
+        np.save(os.path.join(tmp_path, f'{i}.npy'), values)
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # кэш уже записан другим процессом
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+
+def read_cache(cache_path, start=None, stop=None, variables=None):
+    '''
+    Считывает 'df' из кэша 'cache_path' за период от 'start' до 'stop'.
+    
+    Parameters
+    ----------
+    cache_path : str
+        Путь к папке кэша одного файла (см. write_cache).
+    start : str, Timestamp; optional
+        Начало считываемого периода.
+        Default: None
+    stop : str, Timestamp; optional
+        Конец считываемого периода (включительно).
+        Default: None
+    variables : list of str; optional
+        Список считываемых переменных. Если не задан, считываются все колонки кэша.
+        Default: None
+    
+    Returns
+    -------
+    df : pd.DataFrame
+        Датафрейм, содержащий данные из кэша. Если в кэше нет данных за период, возвращается пустой датафрейм.
+    
+    Файлы кэша открываются через np.memmap только для поиска периода: выбранный период копируется в память 
+    и сразу декодируется в float64. Возвращаемый 'df' всегда float64 (8 байт на значение), поэтому кодек 'int16' 
+    уменьшает только размер кэша на диске, а не объем памяти при обработке.
+    '''
+    
+    with open(os.path.join(cache_path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    index = np.load(os.path.join(cache_path, 'index.npy'), mmap_mode='r')
+
+    i0 = 0 if start is None else np.searchsorted(index, pd.to_datetime(start).to_datetime64(), side='left')
+    i1 = len(index) if stop is None else np.searchsorted(index, pd.to_datetime(stop).to_datetime64(), side='right')
+
+    if i0 >= i1:
+        return pd.DataFrame()
+
+    data = {}
+    for i, column in enumerate(meta['columns']):
+        if variables is not None and column not in variables:
+            continue
+        values = np.load(os.path.join(cache_path, f'{i}.npy'), mmap_mode='r')[i0:i1]
+        if meta.get('codec') == 'int16':
+            values = decode_int16(values, meta['scale'][i], meta['offset'][i])
+        data[column] = values
+
+    df = pd.DataFrame(data, index=pd.DatetimeIndex(index[i0:i1]), copy=True)
+    
+    return df
+
+
+
+def read_cached(file, func, cache_dir, start=None, stop=None, variables=None, codec=None, resolution=0.01):
+    '''
+    Считывает файл 'file' функцией 'func' через кэш 'cache_dir'.
+    
+    Parameters
+    ----------
+    file : str
+        Полное имя исходного файла.
+    func : function
+        Читалка для одного файла (например  nc_to_df).
+    cache_dir : str
+        Папка кэша. Если папки нет, она будет создана.
+    start : str, Timestamp; optional
+        Начало считываемого периода.
+        Default: None
+    stop : str, Timestamp; optional
+        Конец считываемого периода (включительно).
+        Default: None
+    variables : list of str; optional
+        Список считываемых переменных. Передается в 'func', если задан.
+        Default: None
+    codec : {None, 'int16'}; optional
+        Кодек хранения кэша (см. write_cache).
+        Default: None
+    resolution : float or dict; optional
+        Шаг квантования для codec='int16' (см. write_cache).
+        Default: 0.01
+    
+    Returns
+    -------
+    df : pd.DataFrame
+        Датафрейм с колонками float64 и индексом pd.DatetimeIndex, содержащий данные из считанного файла.
+    
+    Ключ кэша зависит от пути, размера и времени модификации файла, поэтому измененный файл будет декодирован заново.
+    При первом считывании файл декодируется и кэшируется целиком (с учетом 'variables'), даже если период от 'start' до 'stop' 
+    покрывает только его часть: кэш не зависит от периода и переиспользуется для любых периодов, выбираемых уже из кэша.
+    При изменении файла старая запись кэша не удаляется, для удаления устаревших записей используйте clean_cache.
+    Для параллельного считывания используйте functools.partial(read_cached, func=func, cache_dir=cache_dir).
+    '''
+    
+    cache_path = os.path.join(cache_dir, cache_key(file, variables))
+    if codec:
+        cache_path = f'{cache_path}_{codec}'
+
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        df = func(file, variables=variables) if variables is not None else func(file)
+        df = df.astype('float64', copy=False)
+        df.index = pd.to_datetime(df.index)
+        write_cache(df, cache_path, source=os.path.abspath(file), codec=codec, resolution=resolution, variables=variables)
+
+    df = read_cache(cache_path, start, stop)
+    
+    return df
+
+
+
+def clean_cache(cache_dir, logger=None):
+    '''
+    Удаляет из кэша 'cache_dir' устаревшие записи: исходный файл удален или изменен (ключ записи не совпадает с cache_key).
+    
+    Parameters
+    ----------
+    cache_dir : str
+        Папка кэша (см. read_cached).
+    logger : logging.Logger; optional
+        Если задан, записывает лог.
+        Default: None
+    
+    Returns
+    -------
+    removed : int
+        Количество удаленных записей.
+    
+    Ключ записи вычисляется по пути, размеру и времени модификации исходного файла, поэтому после изменения файла 
+    read_cached создает новую запись, а старая остается на диске. Записи без метаданных (в том числе недописанные 
+    временные папки) не удаляются.
+    '''
+    
+    removed = 0
+    if not os.path.isdir(cache_dir):
+        return removed
+
+    for name in os.listdir(cache_dir):
+        cache_path = os.path.join(cache_dir, name)
+        try:
+            with open(os.path.join(cache_path, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        source = meta.get('source')
+        if not source:
+            continue
+        if not os.path.exists(source) or cache_key(source, meta.get('variables')) != name.split('_')[0]:
+            shutil.rmtree(cache_path, ignore_errors=True)
+            removed += 1
+
+    if logger:
+        logger.info(f'Cache {cache_dir}: {removed} stale entries removed')
+    
+    return removed
+
+
+
+def encode_int16(values, resolution=0.01):
+    '''
+    Квантует массив 'values' в int16 со смещением 'offset' и шагом 'scale'.
+    
+    Parameters
+    ----------
+    values : np.ndarray
+        Массив значений float, может содержать np.nan.
+    resolution : float; optional
+        Требуемый шаг квантования (разрешение прибора).
+        Default: 0.01
+    
+    Returns
+    -------
+    codes : np.ndarray
+        Массив int16, пустые значения (np.nan) записываются как -32768.
+    scale : float
+        Шаг квантования. Равен 'resolution', если диапазон значений в него укладывается, иначе увеличивается.
+    offset : float
+        Смещение, соответствующее коду 0 (середина диапазона значений).
+    
+    Значения восстанавливаются как codes * scale + offset (см. decode_int16) с ошибкой не более scale / 2.
+    Кодирование используется только для хранения кэша на диске, при считывании значения декодируются в float64.
+    Если диапазон значений не укладывается в 65533 шага 'resolution', шаг увеличивается до (max - min) / 65532.
+    '''
+    
+    values = np.asarray(values, dtype='float64')
+    finite = np.isfinite(values)
+
+    if finite.any():
+        vmin = values[finite].min()
+        vmax = values[finite].max()
+    else:
+        vmin = vmax = 0.0
+
+    scale = float(max(resolution, (vmax - vmin) / 65532))
+    offset = float(np.round((vmax + vmin) / 2 / scale) * scale)
+
+    codes = np.full(values.shape, -32768, dtype='int16')
+    codes[finite] = np.clip(np.round((values[finite] - offset) / scale), -32767, 32767)
+    
+    return codes, scale, offset
+
+
+
+def decode_int16(codes, scale, offset):
+    '''
+    Восстанавливает массив float64 из кодов int16, полученных encode_int16.
+    
+    Parameters
+    ----------
+    codes : np.ndarray
+        Массив int16 (в том числе np.memmap).
+    scale : float
+        Шаг квантования.
+    offset : float
+        Смещение, соответствующее коду 0.
+    
+    Returns
+    -------
+    values : np.ndarray
+        Новый массив float64 (8 байт на значение), коды -32768 заменены на np.nan.
+    '''
+    
+    values = codes * scale + offset
+    values[codes == -32768] = np.nan
+    
+    return values
@@ -1,6 +1,12 @@
 import pandas as pd
 import numpy as np
-from eclib.preprocessing import create_bins
+from itertools import combinations_with_replacement
+from eclib.preprocessing import as_bin_index
+from eclib.dataquality import moment_statistics
+
+# Моменты, рассчитываемые за каждый период осреднения (в порядке колонок таблицы моментов)
+SECOND_MOMENTS = ['uu', 'vv', 'ww', 'tt', 'wu', 'wv', 'wt']
+THIRD_MOMENTS = ['wuu', 'wvv', 'wtt', 'wwt', 'uuu', 'vvv', 'www', 'ttt']
 
 def means(df, df_bins=None, step=None, start=None, stop=None, prefix=False):
     '''
@@ -10,8 +16,8 @@ def means(df, df_bins=None, step=None, start=None, stop=None, prefix=False):
     ----------
     df : pd.DataFrame or pd.Series
         Входной датафрейм или временной ряд, содержащий данные, для которых будет производится расчет средних значний.
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -35,12 +41,9 @@ def means(df, df_bins=None, step=None, start=None, stop=None, prefix=False):
         DataFrame, содержащий осредненные значения по входному df.
     '''
     
-    if not df_bins: 
-        df_bins = create_bins(step, df, start, stop)
+    df_bins = as_bin_index(df_bins, df, step, start, stop)
         
-    df_mean = df.groupby(df_bins, observed=True).mean()
-
-    df_mean.index = df_mean.index.map(lambda x: x.left)
+    df_mean = df_bins.to_frame(df_bins.mean(df), df)
 
     if prefix: 
         df_mean = df_mean.add_prefix('_mean')
@@ -49,7 +52,7 @@ def means(df, df_bins=None, step=None, start=None, stop=None, prefix=False):
 
 
 
-def pulsations(ser, df_bins=None, step=None, start=None, stop=None, df_means=None, inplace=None):
+def pulsations(ser, df_bins=None, step=None, start=None, stop=None, df_means=None, inplace=None, outside='nan'):
     '''
     Рассчитывает в 'ser' пульсации по периодам осреднения 'df_bins'.
     
@@ -57,8 +60,8 @@ def pulsations(ser, df_bins=None, step=None, start=None, stop=None, df_means=Non
     ----------
     ser : pd.DataFrame or pd.Series
         Входной датафрейм или временной ряд, содержащий данные, для которых будет производится расчет пульсаций.
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -78,35 +81,74 @@ def pulsations(ser, df_bins=None, step=None, start=None, stop=None, df_means=Non
     inplace : bool; optional
         Если False, сделает копию 'ser', если True перезапишет 'ser'.
         Default: None
+    outside : {'nan', 'keep', 'drop'}; optional
+        Обработка значений вне периодов осреднения 'df_bins' (например, неполного последнего периода, не вошедшего в create_bins):
+        'nan' - заменяются на np.nan, 'keep' - остаются без изменений, 'drop' - исключаются из выходного объекта 
+        (при inplace=True 'ser' остается полной длины, значения вне периодов заменяются на np.nan).
+        Прежняя версия возвращала 'ser', обрезанный после последнего периода осреднения, с неизмененными значениями 
+        вне периодов до него. По умолчанию ('nan') выходной объект имеет полную длину 'ser', а значения вне периодов - np.nan.
+        Default: 'nan'
     
     Returns
     -------
     puls : pd.DataFrame
         Объект идентичный входному 'ser', содержащий рассчитанные пульсации.
-    
+
+    Средние периодов осреднения разворачиваются на все значения через номера интервалов (см. BinIndex.broadcast) и вычитаются 
+    одной операцией, для регулярного разбиения - вдоль оси 1 (см. BinIndex.to_grid). Значения копируются в массив float64: 
+    при inplace=True колонки обрабатываются по одной и записываются обратно в 'ser', поэтому дополнительная память - 
+    одна колонка, иначе - копия всего 'ser'.
     '''
     
-    if not inplace: 
-        ser = ser.copy()
-
-    if df_bins is None: 
-        df_bins = create_bins(ser, step, start, stop)
+    df_bins = as_bin_index(df_bins, ser, step, start, stop)
 
     if df_means is None:
         df_means = means(ser, df_bins)
+    if isinstance(ser, pd.DataFrame):
+        df_means = df_means[ser.columns]
+    mean = np.asarray(df_means.reindex(df_bins.left), dtype='float64')
+    inside = df_bins.ids >= 0
 
-    ind = ser.index[-1]
-    
-    for bins, group in ser.groupby(df_bins, observed=True):
-        ser[bins.left:bins.right] = group - df_means.loc[bins.left]
-        ind = group.index[-1]
-        
-    puls = ser[:ind]
+    if inplace:
+        # колонки обрабатываются по одной, чтобы не копировать весь 'ser'
+        if isinstance(ser, pd.Series):
+            ser.iloc[:] = _subtract_means(ser.to_numpy(dtype='float64', copy=True), mean, df_bins, inside, outside)
+        else:
+            for i, column in enumerate(ser.columns):
+                ser[column] = _subtract_means(ser[column].to_numpy(dtype='float64', copy=True), mean[:, i], df_bins, inside, outside)
+        puls = ser
+    else:
+        values = _subtract_means(ser.to_numpy(dtype='float64', copy=True), mean, df_bins, inside, outside)
+        if isinstance(ser, pd.DataFrame):
+            puls = pd.DataFrame(values, index=ser.index, columns=ser.columns)
+        else:
+            puls = pd.Series(values, index=ser.index, name=ser.name)
+
+    if outside == 'drop':
+        puls = puls[inside]
     
     return puls
 
 
 
+def _subtract_means(values, mean, df_bins, inside, outside):
+    '''
+    Вычитает на месте из 'values' (ряд или ряды по колонкам) средние 'mean' их периодов осреднения (см. pulsations).
+    '''
+    if df_bins.regular:
+        # для регулярного разбиения средние вычитаются сразу из всех периодов осреднения
+        grid = df_bins.to_grid(values)
+        grid -= mean[:, None]
+    else:
+        values[inside] -= mean[df_bins.ids[inside]]
+
+    if outside != 'keep':
+        values[~inside] = np.nan
+
+    return values
+
+
+
 def stat_moments(puls, df_bins=None, step=None, start=None, stop=None):
     '''
     Рассчитывает по 'puls' турбулентные моменты по периодам осреднения 'df_bins' или от 'start' до 'stop' с шагом 'step'.
@@ -115,8 +157,8 @@ def stat_moments(puls, df_bins=None, step=None, start=None, stop=None):
     ----------
     puls : pd.DataFrame or pd.Series
         Входной датафрейм или временной ряд, содержащий данные, для которых будет производится расчет пульсаций.
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -135,8 +177,7 @@ def stat_moments(puls, df_bins=None, step=None, start=None, stop=None):
     -------
     moments
     '''
-    if not df_bins: 
-        df_bins = create_bins(ser, step, start, stop)
+    df_bins = as_bin_index(df_bins, puls, step, start, stop)
         
     moments = puls.prod(axis=1, skipna=False)
     moments.name = ''.join(puls.columns)
@@ -145,6 +186,285 @@ def stat_moments(puls, df_bins=None, step=None, start=None, stop=None):
         
     return moments
 
+def co_moments(puls, df_bins=None, step=None, start=None, stop=None, variables=None, max_order=3, moments=None, chunk_size=1_000_000):
+    '''
+    Рассчитывает по 'puls' все смешанные моменты до порядка 'max_order' (или заданные 'moments') по периодам осреднения за один проход.
+    
+    Parameters
+    ----------
+    puls : pd.DataFrame
+        Входной датафрейм, содержащий пульсации (см. pulsations).
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
+        Default: None.
+    step : int, float, Timedelta; optional
+        Длина интервала осреднения. 
+        Используется, если не задан 'df_bins'. Если не заданы 'step' и 'df_bins', программа закончится ошибкой.
+        Default: None.
+    start : int, float, Timestamp; optional
+        Начало обрабатываемого периода. 
+        Используется, если не задан 'df_bins'. Если None, берется первый индекс 'puls' (не рекомендуется, см. create_bins). 
+        Default: None.
+    stop : int, float, Timestamp; optional
+        Конец обрабатываемого периода. 
+        Используется, если не задан 'df_bins'. Если None, берется последний индекс 'puls' (не рекомендуется, см. create_bins).
+        Default: None.
+    variables : list of str; optional
+        Величины, из которых составляются моменты. Если None, используются все колонки 'puls'.
+        Default: None.
+    max_order : int; optional
+        Максимальный порядок моментов. Используется, если не задан 'moments'.
+        Default: 3.
+    moments : list of str or list of tuple; optional
+        Моменты для расчета, например ['uu', 'wu', 'wuu'] или [('w', 'temp')]. Если None, рассчитываются все моменты 
+        'variables' порядка от 2 до 'max_order'.
+        Default: None.
+    chunk_size : int; optional
+        Количество значений, обрабатываемых за один шаг (ограничивает расход памяти на произведения).
+        Default: 1_000_000.
+    
+    Returns
+    -------
+    df_moments : pd.DataFrame
+        Таблица моментов с индексом левых границ периодов осреднения (как stat_moments), названия колонок - 
+        названия величин момента подряд ('wuu').
+
+    Значение каждого момента совпадает с stat_moments: среднее произведения по значениям, где известны все его величины.
+    Каждое произведение вычисляется один раз и переиспользуется для моментов старших порядков (uu -> uuw), 
+    моменты, отличающиеся порядком величин ('wu' и 'uw'), считаются один раз. Суммы по периодам осреднения накапливаются 
+    по частям ряда длиной 'chunk_size'.
+    '''
+
+    df_bins = as_bin_index(df_bins, puls, step, start, stop)
+
+    variables = list(puls.columns) if variables is None else list(variables)
+    if moments is None:
+        moments = [combination for order in range(2, max_order + 1) for combination in combinations_with_replacement(variables, order)]
+    moments = [tuple(moment) for moment in moments]
+
+    # произведения задаются отсортированными номерами колонок, для каждого нужен и его префикс на порядок меньше
+    columns = list(dict.fromkeys(name for moment in moments for name in moment))
+    keys = [tuple(sorted(columns.index(name) for name in moment)) for moment in moments]
+    unique = list(dict.fromkeys(keys))
+    needed = set()
+    for key in unique:
+        needed.update(key[:order] for order in range(1, len(key) + 1))
+    needed = sorted(needed, key=len)
+
+    values = puls[columns].to_numpy(dtype='float64')
+    sums = np.zeros((len(df_bins), len(unique)))
+    counts = np.zeros((len(df_bins), len(unique)))
+
+    for chunk in range(0, len(values), chunk_size):
+        ids = df_bins.ids[chunk:chunk + chunk_size]
+        inside = ids >= 0
+        ids = ids[inside]
+        x = values[chunk:chunk + chunk_size][inside]
+
+        products = {}
+        for key in needed:
+            products[key] = x[:, key[0]] if len(key) == 1 else products[key[:-1]] * x[:, key[-1]]
+
+        for j, key in enumerate(unique):
+            valid = np.isfinite(products[key])
+            sums[:, j] += np.bincount(ids, weights=np.where(valid, products[key], 0.0), minlength=len(df_bins))
+            counts[:, j] += np.bincount(ids, weights=valid, minlength=len(df_bins))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = sums / counts
+
+    observed = df_bins.observed
+    return pd.DataFrame(result[observed][:, [unique.index(key) for key in keys]], index=df_bins.left[observed], 
+                        columns=[''.join(moment) for moment in moments])
+
+
+
+class MomentAccumulator:
+    '''
+    Сливаемые накопители статистик по периодам осреднения: количество, среднее, суммы центральных моментов 
+    до 4 порядка для каждой величины и ковариации всех пар величин.
+
+    Attributes
+    ----------
+    variables : list of str
+        Величины (колонки входных данных).
+    left : pd.Index
+        Левые границы периодов осреднения, по ним сливаются накопители разных частей данных.
+    n, mean, m2, m3, m4 : np.ndarray
+        Количество непустых значений, среднее и суммы степеней отклонений от среднего, размер (n_bins, n_variables).
+    pair_n, pair_mean, pair_c : np.ndarray
+        Для каждой пары величин (i, j), размер (n_bins, n_variables, n_variables): количество значений, где известны обе величины, 
+        среднее величины i по этим значениям и сумма произведений отклонений.
+
+    Накопитель строится по части данных (файлу, куску ряда, части периода осреднения в другом процессе) и сливается 
+    с другими (см. merge) по формулам Чана (Chan et al., 1979) без повторного чтения данных, результат совпадает с расчетом 
+    по всем данным сразу. Суммы отклонений от среднего устойчивее сумм степеней исходных значений.
+    Моменты выдаются в тех же единицах, что и means, stat_moments, dq.skewness, dq.kurtosis (см. table, moments).
+    '''
+
+    def __init__(self, variables, left=None):
+        self.variables = list(variables)
+        self.left = pd.Index([] if left is None else left)
+        shape = (len(self.left), len(self.variables))
+        self.n, self.mean, self.m2, self.m3, self.m4 = (np.zeros(shape) for _ in range(5))
+        self.pair_n, self.pair_mean, self.pair_c = (np.zeros(shape + shape[1:]) for _ in range(3))
+
+    @classmethod
+    def from_frame(cls, df, df_bins=None, step=None, start=None, stop=None, variables=None):
+        '''
+        Создает накопитель по данным 'df' и периодам осреднения 'df_bins' (или 'step', 'start', 'stop', см. create_bins).
+        '''
+        df_bins = as_bin_index(df_bins, df, step, start, stop)
+        acc = cls(df.columns if variables is None else variables, df_bins.left)
+
+        inside = df_bins.ids >= 0
+        ids = df_bins.ids[inside]
+        x = df[acc.variables].to_numpy(dtype='float64')[inside]
+        valid = np.isfinite(x)
+        x0 = np.where(valid, x, 0.0)
+        n_bins = len(df_bins)
+
+        def per_bin(weights):
+            return np.column_stack([np.bincount(ids, weights=column, minlength=n_bins) for column in weights.T])
+
+        # моменты отдельных величин: среднее, затем суммы степеней отклонений от него (два прохода по куску)
+        acc.n = per_bin(valid.astype('float64'))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            acc.mean = np.nan_to_num(per_bin(x0) / acc.n)
+        d = np.where(valid, x - acc.mean[ids], 0.0)
+        acc.m2 = per_bin(d ** 2)
+        acc.m3 = per_bin(d ** 3)
+        acc.m4 = per_bin(d ** 4)
+
+        # ковариации по значениям, где известны обе величины пары
+        for i in range(len(acc.variables)):
+            for j in range(i, len(acc.variables)):
+                both = valid[:, i] & valid[:, j]
+                n = np.bincount(ids, weights=both, minlength=n_bins)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean_i = np.nan_to_num(np.bincount(ids, weights=np.where(both, x0[:, i], 0.0), minlength=n_bins) / n)
+                    mean_j = np.nan_to_num(np.bincount(ids, weights=np.where(both, x0[:, j], 0.0), minlength=n_bins) / n)
+                c = np.bincount(ids, weights=np.where(both, (x0[:, i] - mean_i[ids]) * (x0[:, j] - mean_j[ids]), 0.0), minlength=n_bins)
+                acc.pair_n[:, i, j] = acc.pair_n[:, j, i] = n
+                acc.pair_mean[:, i, j], acc.pair_mean[:, j, i] = mean_i, mean_j
+                acc.pair_c[:, i, j] = acc.pair_c[:, j, i] = c
+
+        return acc
+
+    def update(self, df, df_bins=None, step=None, start=None, stop=None):
+        '''
+        Добавляет в накопитель данные 'df' (см. from_frame). Возвращает накопитель.
+        '''
+        return self.merge(MomentAccumulator.from_frame(df, df_bins, step, start, stop, self.variables))
+
+    def merge(self, other):
+        '''
+        Сливает с накопителем 'other' (те же величины, любые периоды осреднения). Возвращает накопитель.
+        '''
+        if list(other.variables) != self.variables:
+            raise ValueError(f'Накопители содержат разные величины: {self.variables} и {list(other.variables)}')
+
+        left = self.left.union(other.left)
+        a = self._reindex(left)
+        b = other._reindex(left)
+
+        na, nb = a.n, b.n
+        n = na + nb
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = b.mean - a.mean
+            self.mean = np.nan_to_num(a.mean + delta * nb / n)
+            self.m4 = np.nan_to_num(a.m4 + b.m4 + delta ** 4 * na * nb * (na ** 2 - na * nb + nb ** 2) / n ** 3
+                                    + 6 * delta ** 2 * (na ** 2 * b.m2 + nb ** 2 * a.m2) / n ** 2 + 4 * delta * (na * b.m3 - nb * a.m3) / n)
+            self.m3 = np.nan_to_num(a.m3 + b.m3 + delta ** 3 * na * nb * (na - nb) / n ** 2 + 3 * delta * (na * b.m2 - nb * a.m2) / n)
+            self.m2 = np.nan_to_num(a.m2 + b.m2 + delta ** 2 * na * nb / n)
+
+            na, nb = a.pair_n, b.pair_n
+            n_pair = na + nb
+            delta = b.pair_mean - a.pair_mean
+            self.pair_c = np.nan_to_num(a.pair_c + b.pair_c + delta * delta.transpose(0, 2, 1) * na * nb / n_pair)
+            self.pair_mean = np.nan_to_num(a.pair_mean + delta * nb / n_pair)
+
+        self.n, self.pair_n = n, n_pair
+        self.left = left
+
+        return self
+
+    def _reindex(self, left):
+        acc = MomentAccumulator(self.variables, left)
+        positions = left.get_indexer(self.left)
+        for name in ['n', 'mean', 'm2', 'm3', 'm4', 'pair_n', 'pair_mean', 'pair_c']:
+            getattr(acc, name)[positions] = getattr(self, name)
+        return acc
+
+    def table(self, stat='mean'):
+        '''
+        Таблица статистики 'stat' по периодам осреднения (индекс - левые границы периодов, в которых есть значения, колонки - величины).
+
+        stat : {'count', 'mean', 'var', 'skew', 'kurt'}
+            'count' - количество непустых значений (как dq.counts), 'mean' - среднее (как means), 'var' - дисперсия (ddof=1),
+            'skew', 'kurt' - коэффициенты асимметрии и эксцесса с поправкой на смещение, как pandas (dq.skewness, dq.kurtosis).
+        '''
+        if stat == 'count':
+            values = self.n.astype('int64')
+        elif stat in ('mean', 'var', 'skew', 'kurt'):
+            values = moment_statistics(self.n, self.mean, self.m2, self.m3, self.m4)[stat]
+        else:
+            raise ValueError(f"Недопустимое значение stat: {stat}")
+
+        observed = self.n.max(axis=1) > 0
+        return pd.DataFrame(values[observed], index=self.left[observed], columns=self.variables)
+
+    def moments(self, pairs=None):
+        '''
+        Таблица вторых моментов (ковариаций) пар величин 'pairs' (например, ['uu', 'wu', ('w', 'temp')]), по умолчанию - всех пар.
+        Значение - среднее произведения отклонений по значениям, где известны обе величины, отклонения считаются от средних 
+        по этим же значениям. Если пропуски обеих величин совпадают, значения равны stat_moments по пульсациям.
+        '''
+        if pairs is None:
+            pairs = list(combinations_with_replacement(self.variables, 2))
+        pairs = [tuple(pair) for pair in pairs]
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.column_stack([self.pair_c[:, self.variables.index(i), self.variables.index(j)] / 
+                                      self.pair_n[:, self.variables.index(i), self.variables.index(j)] for i, j in pairs])
+
+        observed = self.n.max(axis=1) > 0
+        return pd.DataFrame(values[observed], index=self.left[observed], columns=[''.join(pair) for pair in pairs])
+
+
+
+def fluxes(df_moments, P=101325):
+    '''
+    Дописывает в таблицу моментов 'df_moments' производные величины: wu_h, H, tau, u_star, L, TKE, A.
+    
+    Parameters
+    ----------
+    df_moments : pd.DataFrame
+        Таблица, содержащая средние 't' и моменты 'uu', 'vv', 'ww', 'wu', 'wv', 'wt' по периодам осреднения.
+    P : int, float; optional
+        Атмосферное давление [Pa], используется для расчета плотности воздуха.
+        Default: 101325
+    
+    Returns
+    -------
+    df_moments : pd.DataFrame
+        Входная таблица с добавленными колонками.
+    '''
+    
+    R = 287  # [J/(kg·K)]
+    Cp = 1005  # [J/(kg·K)]
+    rho = P / (R * (df_moments.t + 273.15))  # [kg/m3]
+
+    df_moments['wu_h']   = (df_moments.wu ** 2 + df_moments.wv ** 2) ** 0.5
+    df_moments['H']      = rho * Cp * df_moments.wt  # [W/m2]
+    df_moments['tau']    = rho * df_moments.wu_h  # [N/m2]
+    df_moments['u_star'] = df_moments.wu_h ** 0.5
+    df_moments['L']      = -(df_moments.t + 273.15) * df_moments.u_star ** 3 / ( 9.8 * 0.4 * df_moments.wt) 
+    df_moments['TKE']    = (df_moments.uu + df_moments.vv + df_moments.ww) / 2
+    df_moments['A']      = df_moments.ww / (df_moments.uu + df_moments.vv + df_moments.ww) 
+    
+    return df_moments
+
 def wind_dir(u, v):
     '''
     Рассчитывает направление ветра 'dir' по направленной на север компоненте 'v' и направленной на восток компоненте 'u'.
@@ -155,5 +475,5 @@ def wind_dir(u, v):
     'dir' : угол по часовой стрелке от направления 'v'.
     '''
     dir = 180 + np.degrees(np.arctan2(u, v))
-    dir = np.where(dir_Uh==360, 0, dir)
+    dir = np.where(dir == 360, 0, dir)
     return dir
@@ -1,6 +1,5 @@
-import pandas as pd
 import numpy as np
-from eclib.preprocessing import create_bins
+from eclib.preprocessing import as_bin_index
 
 def counts(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
     '''
@@ -12,8 +11,8 @@ def counts(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
         Входной датафрейм или временной ряд, содержащие данные, для которых будет производиться фильтрация воротами.
     limit : int, float
         Размер допустимого отклонения от среднего. 
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -37,12 +36,9 @@ def counts(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
         DataFrame, содержащий осредненные значения по входному df.
     '''
     
-    if not df_bins: 
-        df_bins = create_bins(step, df, start, stop)
+    df_bins = as_bin_index(df_bins, df, step, start, stop)
         
-    df_count = df.groupby(df_bins, observed=True).count()
-
-    df_count.index = df_count.index.map(lambda x: x.left)
+    df_count = df_bins.to_frame(df_bins.count(df).astype('int64'), df)
 
     if prefix: 
         df_count = df_count.add_prefix('_count')
@@ -61,8 +57,8 @@ def kurtosis(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
         Входной датафрейм или временной ряд, содержащие данные, для которых будет рассчитываться коэффициент эксцесса.
     limit : int, float
         Размер допустимого отклонения от среднего. 
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -86,12 +82,7 @@ def kurtosis(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
         DataFrame, содержащий осредненные значения по входному 'df'.
     '''
     
-    if not df_bins: 
-        df_bins = create_bins(step, df, start, stop)
-    
-    df_kurt = df.groupby(df_bins, observed=True).agg(pd.Series.kurt)
-
-    df_kurt.index = df_kurt.index.map(lambda x: x.left)
+    df_kurt = statistics(df, df_bins, step, start, stop, stats=['kurt'])['kurt']
 
     if prefix: 
         df_kurt = df_kurt.add_prefix('_kurt')
@@ -110,8 +101,8 @@ def skewness(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
         Входной датафрейм или временной ряд, содержащий данные, для которых будет рассчитываться коэффициент асимметрии.
     limit : int, float
         Размер допустимого отклонения от среднего. 
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -135,12 +126,7 @@ def skewness(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
         DataFrame, содержащий осредненные значения по входному 'df'.
     '''
     
-    if not df_bins: 
-        df_bins = create_bins(step, df, start, stop)
-        
-    df_skew = df.groupby(df_bins, observed=True).skew()
-
-    df_skew.index = df_skew.index.map(lambda x: x.left)
+    df_skew = statistics(df, df_bins, step, start, stop, stats=['skew'])['skew']
 
     if prefix: 
         df_skew = df_skew.add_prefix('_skew')
@@ -149,6 +135,95 @@ def skewness(df, df_bins=None, step=None, start=None, stop=None, prefix=None):
 
 
 
+def statistics(df, df_bins=None, step=None, start=None, stop=None, stats=('count', 'mean', 'var', 'skew', 'kurt'), bias=False):
+    '''
+    Считает в 'df' количество значений, среднее, дисперсию, коэффициенты асимметрии и эксцесса по периодам осреднения 'df_bins' за одну редукцию.
+    
+    Parameters
+    ----------
+    df : pd.DataFrame or pd.Series
+        Входной датафрейм или временной ряд.
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
+        Default: None.
+    step : int, float, Timedelta; optional
+        Длина интервала осреднения. 
+        Используется, если не задан 'df_bins'. Если не заданы 'step' и 'df_bins', программа закончится ошибкой.
+        Default: None.
+    start : int, float, Timestamp; optional
+        Начало обрабатываемого периода. 
+        Используется, если не задан 'df_bins'. Если None, берется первый индекс 'df' (не рекомендуется, см. create_bins). 
+        Default: None.
+    stop : int, float, Timestamp; optional
+        Конец обрабатываемого периода. 
+        Используется, если не задан 'df_bins'. Если None, берется последний индекс 'df' (не рекомендуется, см. create_bins).
+        Default: None.
+    stats : tuple or list of str; optional
+        Рассчитываемые статистики из 'count', 'mean', 'var', 'skew', 'kurt'.
+        Default: ('count', 'mean', 'var', 'skew', 'kurt')
+    bias : bool; optional
+        Если False, дисперсия (ddof=1), асимметрия и эксцесс считаются с поправкой на смещение, как в pandas 
+        (Series.var, Series.skew, Series.kurt). Если True - без поправки (выборочные моменты).
+        Default: False
+    
+    Returns
+    -------
+    df_stats : dict
+        Словарь {статистика: pd.DataFrame или pd.Series} с индексом левых границ периодов осреднения, как у counts, skewness, kurtosis.
+
+    Статистики всех колонок выводятся из одного набора сумм по периодам осреднения: количества, среднего и сумм 2, 3, 4 степеней 
+    отклонений от среднего (см. moment_statistics), суммы степеней всех колонок считаются одной редукцией.
+    '''
+
+    df_bins = as_bin_index(df_bins, df, step, start, stop)
+
+    values = df.to_numpy(dtype='float64')
+    n = df_bins.count(values)
+    mean = df_bins.mean(values)
+
+    # суммы 2, 3, 4 степеней отклонений от среднего всех колонок считаются одной редукцией
+    d = values - df_bins.broadcast(mean)
+    powers = np.empty(d.shape + (3,))
+    np.multiply(d, d, out=powers[..., 0])
+    np.multiply(powers[..., 0], d, out=powers[..., 1])
+    np.multiply(powers[..., 0], powers[..., 0], out=powers[..., 2])
+    sums = df_bins.sum(powers.reshape(len(d), -1)).reshape((len(df_bins),) + powers.shape[1:])
+    m2, m3, m4 = sums[..., 0], sums[..., 1], sums[..., 2]
+    
+    result = moment_statistics(n, mean, m2, m3, m4, bias)
+    result['count'] = n.astype('int64')
+
+    return {stat: df_bins.to_frame(result[stat], df) for stat in stats}
+
+
+
+def moment_statistics(n, mean, m2, m3, m4, bias=False):
+    '''
+    Вычисляет среднее, дисперсию, коэффициенты асимметрии и эксцесса по количеству значений 'n', среднему 'mean' 
+    и суммам 2, 3, 4 степеней отклонений от среднего 'm2', 'm3', 'm4' (массивы одного размера). 
+    Возвращает словарь {'mean', 'var', 'skew', 'kurt'}, поправка на смещение 'bias' как в statistics.
+    '''
+
+    # как в pandas, суммы меньше 1e-14 считаются нулевыми (ошибка округления), для постоянного ряда асимметрия и эксцесс равны 0
+    m2 = np.where(np.abs(m2) < 1e-14, 0.0, m2)
+    m3 = np.where(np.abs(m3) < 1e-14, 0.0, m3)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g1 = np.where(m2 == 0, 0.0, np.sqrt(n) * m3 / m2 ** 1.5)
+        g2 = np.where(m2 == 0, -3.0, n * m4 / m2 ** 2 - 3)
+        if bias:
+            var = m2 / n
+            skew = np.where(n > 0, g1, np.nan)
+            kurt = np.where(n > 0, np.where(m2 == 0, 0.0, g2), np.nan)
+        else:
+            var = m2 / (n - 1)
+            skew = np.where(n > 2, g1 * np.sqrt(n * (n - 1)) / (n - 2), np.nan)
+            kurt = np.where(n > 3, np.where(m2 == 0, 0.0, (n - 1) / ((n - 2) * (n - 3)) * ((n + 1) * g2 + 6)), np.nan)
+
+    return {'mean': np.where(n > 0, mean, np.nan), 'var': var, 'skew': skew, 'kurt': kurt}
+
+
+
 def angle_of_attack_counts(df, df_bins=None, step=None, start=None, stop=None, u_name='u', v_name='v', w_name='w', minaa=-30, maxaa=30):
     '''
     Считает в 'df' количество углов атаки за пределами 'minaa' и 'maxaa' по периодам осреднения 'df_bins'.
@@ -157,8 +232,8 @@ def angle_of_attack_counts(df, df_bins=None, step=None, start=None, stop=None, u
     ----------
     df : pd.DataFrame
         Входной датафрейм, содержащий данные, для которых будет рассчитываться угол атаки.
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -196,12 +271,11 @@ def angle_of_attack_counts(df, df_bins=None, step=None, start=None, stop=None, u
         Временная серия, содержащая моментальные углы атаки за весь период
         
     '''
-    if not df_bins: 
-        df_bins = create_bins(step, df, start, stop)
+    df_bins = as_bin_index(df_bins, df, step, start, stop)
         
     ws = (df[u_name]**2+df[v_name]**2)**(1/2)
     angles = np.degrees(np.arctan(df[w_name]/ws))
-    bad_angle_counts = ((angles < minaa) | (angles > maxaa)).groupby(df_bins, observed=True).sum()
-    bad_angle_counts.index = bad_angle_counts.index.map(lambda x: x.left)
+    bad_angles = (angles < minaa) | (angles > maxaa)
+    bad_angle_counts = df_bins.to_frame(df_bins.sum(bad_angles).astype('int64'), bad_angles)
     
     return bad_angle_counts, angles
\ No newline at end of file
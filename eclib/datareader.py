@@ -1,11 +1,16 @@
 import glob
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import xarray as xr
 import pandas as pd
 import numpy as np
+from eclib.cache import read_cached
 
-def read_all_files(func, files_pattern, logger=None):
+def iter_files(func, files_pattern, logger=None, workers=None, executor='process', start=None, stop=None, variables=None, catalog=None, cache_dir=None, codec=None, info_func=None):
     '''
-    Последовательно считывает функцией 'func' файлы, удовлетворяющие 'files_pattern', и объединяет их в 'df'.
+    Последовательно считывает функцией 'func' файлы, удовлетворяющие 'files_pattern', и по одному выдает их в виде 'df'.
     
     Parameters
     ----------
@@ -16,46 +21,254 @@ def read_all_files(func, files_pattern, logger=None):
     logger : logging.Logger; optional
         Объект вывода для лога.
         Default: None
+    workers : int; optional
+        Количество параллельных процессов (потоков) для декодирования файлов. Если None или 1, файлы считываются последовательно.
+        Default: None
+    executor : {'process', 'thread'}; optional
+        Тип пула для параллельного считывания. Для 'process' функция 'func' должна быть определена на уровне модуля.
+        Default: 'process'
+    start : str, Timestamp; optional
+        Начало считываемого периода. Передается в 'func', файлы целиком раньше 'start' пропускаются.
+        Default: None
+    stop : str, Timestamp; optional
+        Конец считываемого периода. Передается в 'func', файлы целиком позже 'stop' пропускаются.
+        Default: None
+    variables : list of str; optional
+        Список считываемых переменных. Передается в 'func', остальные переменные не декодируются.
+        Default: None
+    catalog : str; optional
+        Путь к файлу каталога (см. update_catalog). Если задан, каталог обновляется, 
+        и считываются только файлы, покрывающие период от 'start' до 'stop' (см. select_files).
+        Default: None
+    info_func : function; optional
+        Функция, считывающая сведения об одном файле для каталога (см. update_catalog). Должна соответствовать 'func' 
+        (например amk_info для amk_to_df). Если None, используется nc_info.
+        Default: None
+    cache_dir : str; optional
+        Папка кэша декодированных файлов. Если задана, файлы считываются через кэш (см. eclib.cache.read_cached). 
+        При первом считывании файл кэшируется целиком, даже если в период от 'start' до 'stop' попадает только его часть. 
+        Записи измененных файлов остаются в кэше, для их удаления используйте eclib.cache.clean_cache.
+        Default: None
+    codec : {None, 'int16'}; optional
+        Кодек хранения кэша. 'int16' хранит колонки квантованными с шагом 0.01 (см. eclib.cache.encode_int16).
+        Уменьшает только размер кэша на диске: выдаваемые 'df' остаются float64.
+        Default: None
         
-    Returns
-    -------
+    Yields
+    ------
     df : pd.DataFrame
-        Датафрейм, содержащий данные из всех считанных файлов. 
+        Датафрейм, содержащий данные из одного считанного файла. 
     
-    Необходимо, чтобы считываемые файлы были однотипными и все читались функцией 'func'.
+    Генератор держит в памяти только один файл (при параллельном считывании - не более 2*'workers' файлов, см. map_window), 
+    поэтому подходит для обработки длинных рядов по частям.
+    Приведение типа к float64 и преобразование индекса к datetime выполняются для каждого файла отдельно.
+    Файлы выдаются в порядке сортировки имен независимо от 'workers'.
+    Параметры 'start', 'stop', 'variables' передаются в 'func' только если заданы, поэтому 'func' должна их поддерживать (см. nc_to_df).
+    Файлы, в которых нет данных за период от 'start' до 'stop', пропускаются и не выдаются.
     При ошибке считывания файла выдаст сообщение об ошибке и продолжит считывание со следующего файла.
     Поддерживает логирование.
     '''
     
-    files = glob.glob(files_pattern)
-    files.sort()
-    
-    df = pd.DataFrame()
+    if catalog:
+        files = select_files(update_catalog(files_pattern, catalog, info_func or nc_info, logger), start, stop)
+    else:
+        files = glob.glob(files_pattern)
+        files.sort()
 
     if logger:
         logger.info(f'Files found: {len(files)}')
+
+    if cache_dir:
+        func = partial(read_cached, func=func, cache_dir=cache_dir, codec=codec)
+
+    kwargs = {key: value for key, value in zip(['start', 'stop', 'variables'], [start, stop, variables]) if value is not None}
+
+    if workers and workers > 1:
+        pool = ProcessPoolExecutor(workers) if executor == 'process' else ThreadPoolExecutor(workers)
+        results = map_window(pool, func, files, kwargs, 2*workers)
+    else:
+        pool = None
+        results = (read_file(func, file, kwargs) for file in files)
+
     i=0
-    for file in files:
-        try:
-            new_df = func(file)
-            df = pd.concat([df,new_df])
+    try:
+        for file, df in zip(files, results):
+            if df is None:
+                if logger:
+                    logger.error(f'Error: {file}')
+                continue
+            if df.empty:
+                if logger:
+                    logger.info(f'{file} is out of range, skipped')
+                continue
             if logger:
                 logger.info(f'{file} has been read')
             i+=1
-        except:
-            if logger:
-                logger.error(f'Error: {file}')
-            break
-    
-    df = df.astype('float64')
-    df.index = pd.to_datetime(df.index)
+            yield df
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
     if logger:
         logger.info(f'Files read: {i}')
+
+
+
+def map_window(pool, func, files, kwargs=None, window=2):
+    '''
+    Считывает файлы 'files' в пуле 'pool' (см. read_file) и выдает результаты по порядку, держа в работе не более 'window' файлов.
+    
+    Parameters
+    ----------
+    pool : concurrent.futures.Executor
+        Пул процессов или потоков.
+    func : function
+        Читалка для одного файла (например  nc_to_df).
+    files : list of str
+        Полные имена файлов.
+    kwargs : dict; optional
+        Дополнительные аргументы 'func' (см. read_file).
+        Default: None
+    window : int; optional
+        Максимальное количество отправленных в пул и еще не выданных файлов.
+        Default: 2
+    
+    Yields
+    ------
+    df : pd.DataFrame or None
+        Результат read_file для очередного файла.
+    
+    В отличие от Executor.map, следующий файл отправляется в пул только после выдачи предыдущего результата, 
+    поэтому медленный потребитель не накапливает в памяти все декодированные файлы.
+    '''
+    
+    futures = deque()
+    for file in files:
+        futures.append(pool.submit(read_file, func, file, kwargs))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+
+def read_file(func, file, kwargs=None):
+    '''
+    Считывает функцией 'func' файл 'file' и приводит его к виду prepare_chunk.
+    
+    Parameters
+    ----------
+    func : function
+        Читалка для одного файла (например  nc_to_df).
+    file : str
+        Полное имя файла.
+    kwargs : dict; optional
+        Дополнительные аргументы 'func' (например 'start', 'stop', 'variables').
+        Default: None
+    
+    Returns
+    -------
+    df : pd.DataFrame or None
+        Датафрейм, содержащий данные из считанного файла, или None, если файл не удалось считать.
+    '''
+    
+    try:
+        return prepare_chunk(func(file, **(kwargs or {})))
+    except Exception:
+        return None
+
+
+
+def read_all_files(func, files_pattern, logger=None, workers=None, executor='process', start=None, stop=None, variables=None, catalog=None, cache_dir=None, codec=None, info_func=None):
+    '''
+    Последовательно считывает функцией 'func' файлы, удовлетворяющие 'files_pattern', и объединяет их в 'df'.
+    
+    Parameters
+    ----------
+    func : function
+        Читалка для одного файла (например  nc_to_df).
+    files_pattern : str
+        Шаблон полного имени файлов. 
+    logger : logging.Logger; optional
+        Объект вывода для лога.
+        Default: None
+    workers : int; optional
+        Количество параллельных процессов (потоков) для декодирования файлов (см. iter_files).
+        Default: None
+    executor : {'process', 'thread'}; optional
+        Тип пула для параллельного считывания (см. iter_files).
+        Default: 'process'
+    start : str, Timestamp; optional
+        Начало считываемого периода (см. iter_files).
+        Default: None
+    stop : str, Timestamp; optional
+        Конец считываемого периода (см. iter_files).
+        Default: None
+    variables : list of str; optional
+        Список считываемых переменных (см. iter_files).
+        Default: None
+    catalog : str; optional
+        Путь к файлу каталога для выбора файлов (см. iter_files).
+        Default: None
+    info_func : function; optional
+        Функция, считывающая сведения об одном файле для каталога (см. iter_files).
+        Default: None
+    cache_dir : str; optional
+        Папка кэша декодированных файлов (см. iter_files).
+        Default: None
+    codec : {None, 'int16'}; optional
+        Кодек хранения кэша (см. iter_files).
+        Default: None
+        
+    Returns
+    -------
+    df : pd.DataFrame
+        Датафрейм, содержащий данные из всех считанных файлов. 
+    
+    Необходимо, чтобы считываемые файлы были однотипными и все читались функцией 'func'.
+    Файлы считываются через iter_files и объединяются одним вызовом pd.concat в конце.
+    Если индексы файлов перекрываются или идут не по порядку, итоговый 'df' сортируется по времени.
+    При ошибке считывания файла выдаст сообщение об ошибке и продолжит считывание со следующего файла.
+    Поддерживает логирование.
+    '''
+    
+    chunks = list(iter_files(func, files_pattern, logger, workers, executor, start, stop, variables, catalog, cache_dir, codec, info_func))
+    
+    if not chunks:
+        return pd.DataFrame()
+    
+    df = pd.concat(chunks)
+
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
+    
+    return df
+
+
+
+def prepare_chunk(df):
+    '''
+    Приводит данные одного считанного файла 'df' к типу float64, а индекс к datetime.
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Датафрейм, содержащий данные из одного файла.
+    
+    Returns
+    -------
+    df : pd.DataFrame
+        Датафрейм с колонками float64 и индексом pd.DatetimeIndex.
+    '''
+    
+    df = df.astype('float64', copy=False)
+    df.index = pd.to_datetime(df.index)
+    
     return df
 
 
 
-def nc_to_df(file):
+def nc_to_df(file, start=None, stop=None, variables=None):
     '''
     Считывает netcdf файлы и конвертирует их в 'df'.
     
@@ -63,15 +276,320 @@ def nc_to_df(file):
     ----------
     file : str
         Полное имя файла.
+    start : str, Timestamp; optional
+        Начало считываемого периода. Если не задано, файл считывается с начала.
+        Default: None
+    stop : str, Timestamp; optional
+        Конец считываемого периода (включительно). Если не задано, файл считывается до конца.
+        Default: None
+    variables : list of str; optional
+        Список считываемых переменных. Если не задан, считываются все переменные.
+        Default: None
+    
+    Returns
+    -------
+    df : pd.DataFrame
+        Датафрейм, содержащий данные из считанного файла.
+    
+    Файл открывается лениво: сначала по координате времени проверяется попадание в период от 'start' до 'stop', 
+    и только затем декодируются выбранные переменные 'variables' за этот период.
+    Если в файле нет данных за период, возвращается пустой датафрейм.
+    '''
+    
+    with xr.open_dataset(file) as ds:
+
+        if variables is not None:
+            ds = ds[[var for var in variables if var in ds.data_vars]]
+
+        if start is not None or stop is not None:
+            # границы приводятся к Timestamp, чтобы строки не срезались по правилу частичной даты xarray 
+            # (stop='2023-01-01 02:30' включал бы всю минуту 02:30)
+            start = None if start is None else pd.to_datetime(start)
+            stop = None if stop is None else pd.to_datetime(stop)
+            dim = list(ds.indexes)[0]
+            time = ds.indexes[dim]
+            if (start is not None and time[-1] < start) or (stop is not None and time[0] > stop):
+                return pd.DataFrame()
+            ds = ds.sel({dim: slice(start, stop)})
+
+        df = ds.to_dataframe()
+    
+    return df
+
+
+
+# Раскладка бинарной записи сырых данных акустических анемометров АМК-03/АМК-04:
+# время (мс от 1970-01-01 UTC), компоненты скорости ветра u, v, w и акустическая температура в сотых долях единиц.
+# Если запись прибора отличается (версия прошивки, набор каналов), передайте свои 'record_dtype' и 'scales' в amk_to_df.
+AMK_RECORD = np.dtype([('time', '<i8'), ('u', '<i2'), ('v', '<i2'), ('w', '<i2'), ('temp', '<i2')])
+AMK_SCALES = {'u': 0.01, 'v': 0.01, 'w': 0.01, 'temp': 0.01}
+AMK_NAN = -32768
+
+
+
+def amk_to_df(file, start=None, stop=None, variables=None, record_dtype=AMK_RECORD, scales=AMK_SCALES, time_unit='ms', chunk_size=1_000_000):
+    '''
+    Считывает бинарный файл сырых данных акустического анемометра АМК-03/АМК-04 и конвертирует его в 'df'.
+    
+    Parameters
+    ----------
+    file : str
+        Полное имя файла.
+    start : str, Timestamp; optional
+        Начало считываемого периода. Если не задано, файл считывается с начала.
+        Default: None
+    stop : str, Timestamp; optional
+        Конец считываемого периода (включительно). Если не задано, файл считывается до конца.
+        Default: None
+    variables : list of str; optional
+        Список считываемых переменных. Если не задан, считываются все поля записи, кроме 'time'.
+        Default: None
+    record_dtype : np.dtype; optional
+        Структурированный тип одной записи. Должен содержать поле 'time'.
+        Default: AMK_RECORD
+    scales : dict; optional
+        Множители для перевода целочисленных полей в физические единицы {поле: множитель}.
+        Default: AMK_SCALES
+    time_unit : str; optional
+        Единица поля 'time' (см. pd.to_datetime).
+        Default: 'ms'
+    chunk_size : int; optional
+        Количество записей, декодируемых за один шаг.
+        Default: 1000000
     
     Returns
     -------
     df : pd.DataFrame
         Датафрейм, содержащий данные из считанного файла.
+    
+    Файл отображается в память как массив записей 'record_dtype' (np.memmap), без построчного разбора.
+    Период от 'start' до 'stop' находится бинарным поиском по полю 'time', декодируются только попавшие в него записи.
+    Декодирование идет блоками по 'chunk_size' записей, чтобы не создавать промежуточных массивов размером с файл.
+    Значения AMK_NAN в целочисленных полях заменяются на np.nan. Неполная запись в конце файла отбрасывается.
+    Функция совместима с read_all_files (в том числе с параметрами 'start', 'stop', 'variables').
     '''
     
-    ds = xr.open_dataset(file)
+    count = os.path.getsize(file) // record_dtype.itemsize
+    if count == 0:
+        return pd.DataFrame()
+    
+    records = np.memmap(file, dtype=record_dtype, mode='r', shape=(count,))
+    time = records['time']
+
+    i0 = 0 if start is None else np.searchsorted(time, pd.to_datetime(start).value // pd.Timedelta(1, time_unit).value, side='left')
+    i1 = count if stop is None else np.searchsorted(time, pd.to_datetime(stop).value // pd.Timedelta(1, time_unit).value, side='right')
+
+    if i0 >= i1:
+        return pd.DataFrame()
+
+    if variables is None:
+        variables = [name for name in record_dtype.names if name != 'time']
+    else:
+        variables = [name for name in variables if name in record_dtype.names]
 
-    df = ds.to_dataframe()
+    data = {name: np.empty(i1 - i0, dtype='float64') for name in variables}
+    for j in range(i0, i1, chunk_size):
+        block = records[j:min(j + chunk_size, i1)]
+        for name in variables:
+            values = block[name].astype('float64')
+            if np.issubdtype(record_dtype[name], np.integer):
+                values[block[name] == AMK_NAN] = np.nan
+            data[name][j - i0:j - i0 + len(block)] = values * scales.get(name, 1)
+
+    df = pd.DataFrame(data, index=pd.to_datetime(np.asarray(time[i0:i1]), unit=time_unit).as_unit('ns'))
+    df.index.name = 'time'
     
     return df
+
+
+
+def nc_info(file):
+    '''
+    Считывает из заголовка netcdf файла временное покрытие, частоту и список переменных.
+    
+    Parameters
+    ----------
+    file : str
+        Полное имя файла.
+    
+    Returns
+    -------
+    info : dict
+        Словарь с ключами 'first', 'last' (первый и последний момент времени), 'frequency' (частота, Гц) 
+        и 'variables' (имена переменных через пробел).
+    
+    Значения переменных не декодируются, считывается только координата времени.
+    '''
+    
+    with xr.open_dataset(file) as ds:
+        time = ds.indexes[list(ds.indexes)[0]]
+        if len(time) > 1:
+            frequency = 1 / pd.Series(time).diff().median().total_seconds()
+        else:
+            frequency = np.nan
+        info = {
+            'first': time[0], 
+            'last': time[-1], 
+            'frequency': np.round(frequency, 3), 
+            'variables': ' '.join(ds.data_vars)
+        }
+    
+    return info
+
+
+
+def amk_info(file, record_dtype=AMK_RECORD, time_unit='ms'):
+    '''
+    Считывает из бинарного файла АМК-03/АМК-04 временное покрытие, частоту и список переменных (см. nc_info).
+    
+    Parameters
+    ----------
+    file : str
+        Полное имя файла.
+    record_dtype : np.dtype; optional
+        Структурированный тип одной записи (см. amk_to_df).
+        Default: AMK_RECORD
+    time_unit : str; optional
+        Единица поля 'time' (см. pd.to_datetime).
+        Default: 'ms'
+    
+    Returns
+    -------
+    info : dict
+        Словарь с ключами 'first', 'last', 'frequency', 'variables'.
+    
+    Считываются только первая и последняя записи файла.
+    '''
+    
+    count = os.path.getsize(file) // record_dtype.itemsize
+    records = np.memmap(file, dtype=record_dtype, mode='r', shape=(count,))
+    first = pd.to_datetime(records['time'][0], unit=time_unit)
+    last = pd.to_datetime(records['time'][-1], unit=time_unit)
+    frequency = (count - 1) / (last - first).total_seconds() if count > 1 and last > first else np.nan
+    info = {
+        'first': first, 
+        'last': last, 
+        'frequency': np.round(frequency, 3), 
+        'variables': ' '.join(name for name in record_dtype.names if name != 'time')
+    }
+    
+    return info
+
+
+
+def update_catalog(files_pattern, catalog_path, info_func=nc_info, logger=None):
+    '''
+    Обновляет каталог файлов 'catalog_path' для файлов, удовлетворяющих 'files_pattern'.
+    
+    Parameters
+    ----------
+    files_pattern : str
+        Шаблон полного имени файлов. 
+    catalog_path : str
+        Путь к csv файлу каталога. Если файла нет, он будет создан.
+    info_func : function; optional
+        Функция, считывающая сведения об одном файле (см. nc_info).
+        Default: nc_info
+    logger : logging.Logger; optional
+        Объект вывода для лога.
+        Default: None
+    
+    Returns
+    -------
+    catalog : pd.DataFrame
+        Каталог с колонками 'path', 'size', 'mtime' (нс), 'first', 'last', 'frequency', 'variables', отсортированный по 'path'.
+    
+    Заголовки считываются только для новых файлов и файлов, у которых изменились размер или время модификации, 
+    сведения об остальных файлах берутся из каталога. Удаленные файлы исключаются из каталога.
+    При ошибке считывания файла выдаст сообщение об ошибке и не добавит файл в каталог.
+    Поддерживает логирование.
+    '''
+    
+    files = glob.glob(files_pattern)
+    files.sort()
+
+    if os.path.exists(catalog_path):
+        old_catalog = load_catalog(catalog_path).set_index('path')
+    else:
+        old_catalog = pd.DataFrame(columns=['path', 'size', 'mtime']).set_index('path')
+
+    rows = []
+    updated = 0
+    for file in files:
+        stat = os.stat(file)
+        if file in old_catalog.index and old_catalog.at[file, 'size'] == stat.st_size and old_catalog.at[file, 'mtime'] == stat.st_mtime_ns:
+            rows.append(old_catalog.loc[file].to_dict() | {'path': file})
+            continue
+        try:
+            info = info_func(file)
+        except Exception:
+            if logger:
+                logger.error(f'Error: {file}')
+            continue
+        rows.append({'path': file, 'size': stat.st_size, 'mtime': stat.st_mtime_ns} | info)
+        updated += 1
+
+    catalog = pd.DataFrame(rows, columns=['path', 'size', 'mtime', 'first', 'last', 'frequency', 'variables'])
+    catalog.to_csv(catalog_path, index=False)
+
+    if logger:
+        logger.info(f'Catalog {catalog_path}: {len(catalog)} files, {updated} updated')
+    
+    return load_catalog(catalog_path)
+
+
+
+def load_catalog(catalog_path):
+    '''
+    Считывает каталог файлов, созданный update_catalog.
+    
+    Parameters
+    ----------
+    catalog_path : str
+        Путь к csv файлу каталога.
+    
+    Returns
+    -------
+    catalog : pd.DataFrame
+        Каталог файлов (см. update_catalog).
+    '''
+    
+    catalog = pd.read_csv(catalog_path, parse_dates=['first', 'last'], dtype={'variables': str})
+    
+    return catalog
+
+
+
+def select_files(catalog, start=None, stop=None):
+    '''
+    Выбирает из каталога 'catalog' файлы, покрывающие период от 'start' до 'stop'.
+    
+    Parameters
+    ----------
+    catalog : pd.DataFrame or str
+        Каталог файлов или путь к нему (см. update_catalog).
+    start : str, Timestamp; optional
+        Начало периода. Если не задано, ограничение снизу не накладывается.
+        Default: None
+    stop : str, Timestamp; optional
+        Конец периода (включительно). Если не задано, ограничение сверху не накладывается.
+        Default: None
+    
+    Returns
+    -------
+    files : list of str
+        Отсортированный список полных имен файлов.
+    '''
+    
+    if isinstance(catalog, str):
+        catalog = load_catalog(catalog)
+
+    mask = pd.Series(True, index=catalog.index)
+    if start is not None:
+        mask &= catalog['last'] >= pd.to_datetime(start)
+    if stop is not None:
+        mask &= catalog['first'] <= pd.to_datetime(stop)
+    
+    files = sorted(catalog.loc[mask, 'path'])
+    
+    return files
@@ -0,0 +1,274 @@
+import time
+import socket
+import pandas as pd
+import numpy as np
+import eclib.preprocessing as pp
+import eclib.calculation as ec
+
+
+
+def online_moments(samples, avg_period, frequency, columns=('t', 'u', 'v', 'w'), ulims=None, blims=None, limits=None, 
+                   rotation=True, logger=None):
+    '''
+    Рассчитывает турбулентные моменты по потоку измерений 'samples' и выдает строку таблицы моментов сразу после закрытия периода осреднения.
+
+    Parameters
+    ----------
+    samples : iterable
+        Поток измерений в виде пар (время, значения), где значения перечислены в порядке 'columns' (см. parse_lines).
+    avg_period : int, float
+        Период осреднения [мин].
+    frequency : int, float
+        Частота измерений [Гц], используется для выделения буфера одного периода осреднения.
+    columns : tuple or list of str; optional
+        Названия измеряемых величин.
+        Default: ('t', 'u', 'v', 'w')
+    ulims : dict; optional
+        Верхние пороговые значения для фильтрации по абсолютным лимитам (см. absolute_limits_filtration).
+        Если None, используется {'t': 40, 'u': 30, 'v': 30, 'w': 5}.
+        Default: None
+    blims : dict; optional
+        Нижние пороговые значения для фильтрации по абсолютным лимитам (см. absolute_limits_filtration).
+        Если None, используется {'t': -40, 'u': -30, 'v': -30, 'w': -5}.
+        Default: None
+    limits : dict; optional
+        Допустимые отклонения от среднего для фильтрации воротами (см. gates_filtration).
+        Если None, используется {'t': 5, 'u': 20, 'v': 20, 'w': 5}.
+        Default: None
+    rotation : bool; optional
+        Если True, выполняет двойной поворот осей координат (см. axis_rotations с D=2).
+        Default: True
+    logger : logging.Logger; optional
+        Если задан, записывает лог.
+        Default: None.
+
+    Yields
+    ------
+    df_moments : pd.DataFrame
+        Таблица из одной строки с индексом начала периода осреднения и колонками, как у таблицы моментов calculation:
+        средние, моменты второго порядка, производные величины (см. fluxes) и моменты третьего порядка, 
+        а также 'samples' - количество измерений периода и 'complete' - False для последнего периода потока.
+
+    В памяти хранятся только измерения текущего периода осреднения. Период закрывается, когда приходит измерение
+    из следующего периода, последний период выдается по окончании потока и может быть неполным ('complete' = False).
+    Измерения, пришедшие с опозданием (из уже закрытого периода), измерения, в которых количество значений 
+    не совпадает с 'columns' (например, оборванные строки файла или сокета), и строки, которые parse_lines не смог разобрать, 
+    отбрасываются и учитываются в логе.
+    Детрендинг, фильтрация сигмами и заполнение пропусков в потоковом режиме не выполняются.
+    Поддерживает логирование.
+    '''
+
+    columns = list(columns)
+    ulims = {'t': 40, 'u': 30, 'v': 30, 'w': 5} if ulims is None else ulims
+    blims = {'t': -40, 'u': -30, 'v': -30, 'w': -5} if blims is None else blims
+    limits = {'t': 5, 'u': 20, 'v': 20, 'w': 5} if limits is None else limits
+
+    step = pd.Timedelta(minutes=avg_period)
+    buffer = np.empty((int(step.total_seconds() * frequency), len(columns)))
+    n = 0
+    bin_left = None
+    late = 0
+    malformed = 0
+
+    for timestamp, values in samples:
+        if timestamp is None or values is None or len(values) != len(columns):
+            malformed += 1
+            continue
+        timestamp = pd.Timestamp(timestamp)
+        left = timestamp.floor(step)
+
+        if bin_left is None:
+            bin_left = left
+
+        if left != bin_left:
+            if left < bin_left:
+                late += 1
+                continue
+            if n:
+                yield close_period(buffer[:n], bin_left, columns, ulims, blims, limits, rotation, logger, step)
+            n = 0
+            bin_left = left
+            if late and logger:
+                logger.warning(f'Late samples dropped: {late}')
+            if malformed and logger:
+                logger.warning(f'Malformed samples dropped: {malformed}')
+            late = 0
+            malformed = 0
+
+        if n == len(buffer):
+            buffer = np.concatenate([buffer, np.empty_like(buffer)])
+        buffer[n] = values
+        n += 1
+
+    if malformed and logger:
+        logger.warning(f'Malformed samples dropped: {malformed}')
+    if n:
+        yield close_period(buffer[:n], bin_left, columns, ulims, blims, limits, rotation, logger, step, complete=False)
+
+
+
+def close_period(data, bin_left, columns, ulims, blims, limits, rotation=True, logger=None, step=None, complete=True):
+    '''
+    Рассчитывает строку таблицы моментов по измерениям 'data' одного периода осреднения (см. online_moments).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Массив измерений периода осреднения размером (количество измерений, количество величин).
+    bin_left : Timestamp
+        Начало периода осреднения.
+    columns : list of str
+        Названия величин в порядке колонок 'data'.
+    ulims, blims, limits : dict
+        Пороговые значения фильтраций (см. online_moments).
+    rotation : bool; optional
+        Если True, выполняет двойной поворот осей координат.
+        Default: True
+    logger : logging.Logger; optional
+        Если задан, записывает лог.
+        Default: None.
+    step : Timedelta; optional
+        Длина периода осреднения, задает правую границу периода.
+        Default: None.
+    complete : bool; optional
+        Записывается в колонку 'complete': False, если период закрыт окончанием потока и может быть неполным.
+        Default: True.
+
+    Returns
+    -------
+    df_moments : pd.DataFrame
+        Таблица моментов из одной строки с колонками 'samples' (количество измерений) и 'complete'.
+
+    Период обрабатывается теми же функциями, что и пакетный расчет (absolute_limits_filtration, gates_filtration, 
+    axis_rotations, pulsations, co_moments), с разбиением из одного периода осреднения.
+    '''
+
+    df = pd.DataFrame(data, columns=columns)
+    df_bins = pp.BinIndex(np.zeros(len(df), dtype='int32'), [bin_left, bin_left + (step if step is not None else pd.Timedelta(0))])
+
+    for column in columns:
+        if column in ulims or column in blims:
+            df[column] = pp.absolute_limits_filtration(df[column], ulims.get(column, np.inf), blims.get(column, -np.inf))
+
+    pp.gates_filtration(df, limits, df_bins, inplace=True)
+
+    if rotation:
+        pp.axis_rotations(df, D=2, df_bins=df_bins, inplace=True)
+
+    valid = df.count().min()
+
+    df_moments = ec.means(df, df_bins)
+    ec.pulsations(df, df_bins, df_means=df_moments, inplace=True)
+
+    moments = ec.co_moments(df, df_bins, moments=ec.SECOND_MOMENTS + ec.THIRD_MOMENTS)
+    df_moments[ec.SECOND_MOMENTS] = moments[ec.SECOND_MOMENTS]
+    ec.fluxes(df_moments)
+    df_moments[ec.THIRD_MOMENTS] = moments[ec.THIRD_MOMENTS]
+    df_moments['samples'] = len(df)
+    df_moments['complete'] = complete
+
+    if logger:
+        logger.info(f'Period {bin_left} closed, samples: {len(df)}, valid: {valid}')
+
+    return df_moments
+
+
+
+def parse_lines(lines, sep=','):
+    '''
+    Разбирает поток текстовых строк вида "время,значение1,значение2,..." в поток измерений для online_moments.
+
+    Parameters
+    ----------
+    lines : iterable of str
+        Поток строк (файл, sys.stdin, tail_file, socket_lines).
+    sep : str; optional
+        Разделитель полей.
+        Default: ','
+
+    Yields
+    ------
+    sample : tuple
+        Пара (pd.Timestamp, np.ndarray значений). Для строк, которые не удалось разобрать (неверное время или значения), 
+        выдается (None, None), чтобы online_moments учел их как некорректные. Пустые строки пропускаются.
+    '''
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        fields = line.split(sep)
+        try:
+            timestamp = pd.Timestamp(fields[0])
+            values = np.array(fields[1:], dtype='float64')
+        except (ValueError, OverflowError):
+            timestamp = values = None
+        if timestamp is pd.NaT:
+            timestamp = values = None
+        yield timestamp, values
+
+
+
+def tail_file(path, poll=1.0, timeout=None):
+    '''
+    Выдает строки, дописываемые в файл 'path', по мере их появления (аналог tail -f).
+
+    Parameters
+    ----------
+    path : str
+        Полное имя файла.
+    poll : float; optional
+        Интервал опроса файла [с].
+        Default: 1.0
+    timeout : float; optional
+        Если за 'timeout' секунд не появилось новых строк, поток завершается. Если None, поток бесконечный.
+        Default: None
+
+    Yields
+    ------
+    line : str
+        Очередная полная строка файла.
+    '''
+
+    with open(path) as f:
+        waited = 0
+        tail = ''
+        while True:
+            line = f.readline()
+            if line:
+                tail += line
+                if tail.endswith('\n'):
+                    yield tail
+                    tail = ''
+                waited = 0
+                continue
+            if timeout is not None and waited >= timeout:
+                return
+            time.sleep(poll)
+            waited += poll
+
+
+
+def socket_lines(host, port, timeout=None):
+    '''
+    Выдает строки, приходящие по TCP соединению с 'host':'port'.
+
+    Parameters
+    ----------
+    host : str
+        Адрес источника данных.
+    port : int
+        Порт источника данных.
+    timeout : float; optional
+        Таймаут ожидания данных [с]. Если None, ожидание не ограничено.
+        Default: None
+
+    Yields
+    ------
+    line : str
+        Очередная строка. Поток завершается при закрытии соединения.
+    '''
+
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        with sock.makefile('r') as f:
+            yield from f
@@ -1,6 +1,6 @@
 import pandas as pd
 import numpy as np
-from scipy import stats
+from scipy import signal
 
 def create_bins(ser, step, start=None, stop=None):
     '''
@@ -21,8 +21,8 @@ def create_bins(ser, step, start=None, stop=None):
 
     Returns
     -------
-    df_bins : pandas.core.arrays.categorical.Categorical
-        Объект, содержащий границы интервалов осреднения ser.
+    df_bins : BinIndex
+        Объект, содержащий границы интервалов осреднения и номера интервалов для каждого значения 'ser' (см. BinIndex).
     
     Функция поддреживает работу с 'ser', содержащими пропуски.
     Если 'start' и/или 'stop' не задан, функция определит его автоматически на основе 'ser' как первый и последний индекс массива.
@@ -42,12 +42,218 @@ def create_bins(ser, step, start=None, stop=None):
     
     new_indices = np.arange(start, stop, step)
 
-    df_bins = pd.cut(ser.index, bins=new_indices, right=False, include_lowest=True)
+    df_bins = BinIndex.from_edges(ser.index, new_indices)
     
     return df_bins
 
 
 
+class BinIndex:
+    '''
+    Разбиение временного ряда на интервалы осреднения, вычисляемое один раз и используемое всеми функциями eclib.
+
+    Attributes
+    ----------
+    ids : np.ndarray
+        Номер интервала осреднения (int32) для каждого значения ряда, -1 для значений вне интервалов.
+    edges : pd.Index
+        Границы интервалов осреднения (n_bins + 1 значение).
+    left : pd.Index
+        Левые границы интервалов осреднения, используются как индекс выходных таблиц.
+    starts : np.ndarray
+        Позиция первого значения каждого интервала в ряду.
+    counts : np.ndarray
+        Количество значений ряда (включая пустые) в каждом интервале.
+
+    Интервалы включают левую границу "[" и не включают правую ")" (как pd.cut с right=False).
+    Позиционные 'starts' и 'counts' предполагают, что индекс ряда отсортирован по возрастанию.
+    Поддерживает len(), итерацию по позиционным срезам (см. slices) и приведение pd.cut Categorical (см. as_bin_index).
+
+    Для данных с постоянной частотой без пропусков измерений (все интервалы содержат одинаковое количество значений и 
+    идут подряд, см. regular) значения раскладываются в двумерный массив (n_bins, samples_per_bin) без копирования (см. to_grid), 
+    и редукции по интервалам выполняются вдоль оси 1.
+    '''
+
+    def __init__(self, ids, edges):
+        self.ids = np.asarray(ids, dtype='int32')
+        self.edges = pd.Index(edges)
+        self.left = self.edges[:-1]
+        self.right = self.edges[1:]
+        n_bins = len(self.left)
+        self.counts = np.bincount(self.ids[self.ids >= 0], minlength=n_bins)
+        first = np.argmax(self.ids >= 0) if n_bins else 0
+        self.starts = first + np.cumsum(self.counts) - self.counts
+
+    @classmethod
+    def from_edges(cls, index, edges):
+        '''
+        Создает BinIndex для индекса ряда 'index' по границам интервалов 'edges' бинарным поиском (searchsorted).
+        '''
+        edges = pd.Index(edges)
+        ids = edges.searchsorted(index, side='right') - 1
+        ids[(ids < 0) | (ids >= len(edges) - 1)] = -1
+        return cls(ids, edges)
+
+    @classmethod
+    def from_categorical(cls, df_bins):
+        '''
+        Создает BinIndex из pd.cut Categorical с интервалами [left, right) (прежний формат create_bins).
+        '''
+        categories = df_bins.categories
+        edges = categories.left.append(categories.right[-1:])
+        return cls(df_bins.codes, edges)
+
+    def __len__(self):
+        return len(self.left)
+
+    def __iter__(self):
+        return iter(self.slices())
+
+    @property
+    def observed(self):
+        '''
+        Маска интервалов, в которые попало хотя бы одно значение ряда.
+        '''
+        return self.counts > 0
+
+    @property
+    def intervals(self):
+        '''
+        Интервалы осреднения в виде pd.IntervalIndex (для логов и подписей).
+        '''
+        return pd.IntervalIndex.from_arrays(self.left, self.right, closed='left')
+
+    @property
+    def samples_per_bin(self):
+        '''
+        Максимальное количество значений ряда в одном интервале (ширина двумерной раскладки to_grid).
+        '''
+        return int(self.counts.max()) if len(self) else 0
+
+    @property
+    def regular(self):
+        '''
+        True, если все интервалы содержат одинаковое ненулевое количество значений и идут в ряду подряд.
+        В этом случае to_grid возвращает представление (view) исходного массива.
+        '''
+        if not len(self) or self.counts[0] == 0 or (self.counts != self.counts[0]).any():
+            return False
+        return bool(self.starts[-1] == self.starts[0] + (len(self) - 1) * self.counts[0])
+
+    def to_grid(self, values):
+        '''
+        Раскладывает значения ряда 'values' (n или n x колонки) в массив (n_bins, samples_per_bin[, колонки]).
+        Для regular разбиения возвращает представление 'values' без копирования, иначе - копию, 
+        в которой каждый интервал записан с начала строки и дополнен np.nan до samples_per_bin.
+        '''
+        values = np.asarray(values, dtype='float64')
+        shape = (len(self), self.samples_per_bin) + values.shape[1:]
+        if self.regular:
+            start = self.starts[0]
+            return values[start:start + shape[0] * shape[1]].reshape(shape)
+        grid = np.full(shape, np.nan)
+        inside = self.ids >= 0
+        ids = self.ids[inside]
+        grid[ids, np.flatnonzero(inside) - self.starts[ids]] = values[inside]
+        return grid
+
+    def from_grid(self, grid, values):
+        '''
+        Записывает массив 'grid' (см. to_grid) обратно в значения ряда 'values'. Значения вне интервалов не изменяются.
+        '''
+        if self.regular and np.shares_memory(grid, values):
+            return values
+        if self.regular:
+            start = self.starts[0]
+            values[start:start + grid.shape[0] * grid.shape[1]] = grid.reshape((-1,) + grid.shape[2:])
+            return values
+        inside = self.ids >= 0
+        ids = self.ids[inside]
+        values[inside] = grid[ids, np.flatnonzero(inside) - self.starts[ids]]
+        return values
+
+    def slices(self):
+        '''
+        Позиционные срезы значений ряда для каждого интервала осреднения.
+        '''
+        return [slice(start, start + count) for start, count in zip(self.starts, self.counts)]
+
+    def positions(self, bins):
+        '''
+        Позиции значений ряда, попадающих в интервалы 'bins' (номера или двоичная маска интервалов), по возрастанию.
+        '''
+        bins = np.asarray(bins)
+        if bins.dtype == bool:
+            bins = np.flatnonzero(bins)
+        counts = self.counts[bins]
+        offsets = np.repeat(self.starts[bins] - (np.cumsum(counts) - counts), counts)
+        return np.arange(counts.sum()) + offsets
+
+    def count(self, values):
+        '''
+        Количество непустых значений 'values' (1D или 2D по колонкам) в каждом интервале осреднения.
+        '''
+        values = np.asarray(values, dtype='float64')
+        if self.regular:
+            return np.isfinite(self.to_grid(values)).sum(axis=1).astype('float64')
+        inside = self.ids >= 0
+        if values.ndim == 1:
+            return np.bincount(self.ids[inside], weights=np.isfinite(values[inside]), minlength=len(self))
+        return np.column_stack([self.count(column) for column in values.T])
+
+    def sum(self, values):
+        '''
+        Сумма непустых значений 'values' (1D или 2D по колонкам) в каждом интервале осреднения.
+        '''
+        values = np.asarray(values, dtype='float64')
+        if self.regular:
+            return np.nansum(self.to_grid(values), axis=1)
+        inside = self.ids >= 0
+        if values.ndim == 1:
+            return np.bincount(self.ids[inside], weights=np.nan_to_num(values[inside], nan=0.0), minlength=len(self))
+        return np.column_stack([self.sum(column) for column in values.T])
+
+    def mean(self, values):
+        '''
+        Среднее по непустым значениям 'values' (1D или 2D по колонкам) в каждом интервале осреднения.
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(values) / self.count(values)
+
+    def broadcast(self, values):
+        '''
+        Разворачивает значения по интервалам 'values' (n_bins или n_bins x колонки) на все значения ряда, np.nan вне интервалов.
+        '''
+        values = np.asarray(values, dtype='float64')
+        pad = np.full((1,) + values.shape[1:], np.nan)
+        return np.concatenate([values, pad])[self.ids]
+
+    def to_frame(self, values, like, observed=True):
+        '''
+        Оборачивает значения по интервалам 'values' в pd.Series или pd.DataFrame по образцу 'like' с индексом левых границ интервалов.
+        Если 'observed' True, оставляет только интервалы, в которые попало хотя бы одно значение ряда.
+        '''
+        mask = self.observed if observed else np.ones(len(self), dtype=bool)
+        if isinstance(like, pd.DataFrame):
+            return pd.DataFrame(np.asarray(values)[mask], index=self.left[mask], columns=like.columns)
+        return pd.Series(np.asarray(values)[mask], index=self.left[mask], name=like.name)
+
+
+
+def as_bin_index(df_bins, ser=None, step=None, start=None, stop=None):
+    '''
+    Приводит 'df_bins' к BinIndex. Если 'df_bins' не задан, создает его по 'ser', 'step', 'start', 'stop' (см. create_bins).
+    Принимает BinIndex и pd.cut Categorical (прежний формат create_bins).
+    '''
+    
+    if df_bins is None:
+        return create_bins(ser, step, start, stop)
+    if isinstance(df_bins, BinIndex):
+        return df_bins
+    return BinIndex.from_categorical(pd.Categorical(df_bins))
+
+
+
 def find_start_and_lengt(mask):
     '''
     Находит все последовательности элементов, удовлетворяющих 'mask'. 
@@ -60,40 +266,116 @@ def find_start_and_lengt(mask):
 
     Returns
     -------
-    starts : list
-        Список индексов начала последовательностей, удовлетворяющих 'mask'. 
-    lengths : list
-        Список длин последовательностей, удовлетворяющих 'mask'.
-    '''
-    
-    starts = []
-    lengths = []
-    
-    start = None
-  
-    for i, is_True in enumerate(mask):
-        # если встречаем первый раз, запоминаем индекс как начало последовательности
-        if is_True and start:
-            start = i
-        # если после этого встречаем нормальное значение, 
-        # записываем индекс начала последовательности и разницу текущего индекса и индекса начала последовательности
-        elif not is_True and start is not None:
-            length = i - start
-            starts.append(start)
-            lengths.append(length)
-            start = None
-
-    # Если массив заканчивается на True, 
-    # записываем индекс начала и последний индекс массива - индекс начала последовательности
-    if start:
-        length = len(mask) - start
-        starts.append(start)
-        lengths.append(length)
+    starts : np.ndarray
+        Массив индексов начала последовательностей, удовлетворяющих 'mask'. 
+    lengths : np.ndarray
+        Массив длин последовательностей, удовлетворяющих 'mask'.
+
+    Оставлена для совместимости, вычисления выполняет run_lengths.
+    '''
+    
+    starts, lengths, _ = run_lengths(mask)
     
     return starts, lengths
 
 
 
+def run_lengths(mask, ids=None, backend='numpy'):
+    '''
+    Находит все последовательности элементов, удовлетворяющих 'mask', во всем ряду сразу.
+
+    Parameters
+    ----------
+    mask : двоичный массив
+        Массив, содержащий маску элементов, для которых определяются последовательности.
+    ids : np.ndarray; optional
+        Номера интервалов осреднения для каждого элемента (см. BinIndex.ids). Если задан, последовательности
+        разрываются на границах интервалов, а элементы с номером -1 не учитываются.
+        Default: None
+    backend : {'numpy', 'numba'}; optional
+        Реализация ядра. 'numba' использует JIT-компиляцию, если пакет numba установлен, иначе используется 'numpy'.
+        Default: 'numpy'
+
+    Returns
+    -------
+    starts : np.ndarray
+        Позиции начала последовательностей.
+    lengths : np.ndarray
+        Длины последовательностей.
+    run_ids : np.ndarray or None
+        Номер интервала осреднения каждой последовательности, если задан 'ids'.
+    '''
+
+    mask = np.asarray(mask, dtype=bool)
+    if ids is not None:
+        ids = np.asarray(ids)
+        mask = mask & (ids >= 0)
+
+    if backend == 'numba' and _run_lengths_numba is not None:
+        starts, lengths = _run_lengths_numba(mask, np.zeros(len(mask), dtype='int32') if ids is None else ids.astype('int32'))
+    else:
+        # начало последовательности: элемент маски, перед которым нет элемента маски того же интервала
+        head = np.empty(len(mask), dtype=bool)
+        head[:1] = mask[:1]
+        head[1:] = mask[1:] & ~mask[:-1]
+        # конец последовательности: элемент маски, после которого нет элемента маски того же интервала
+        tail = np.empty(len(mask), dtype=bool)
+        tail[-1:] = mask[-1:]
+        tail[:-1] = mask[:-1] & ~mask[1:]
+        if ids is not None:
+            change = ids[1:] != ids[:-1]
+            head[1:] |= mask[1:] & change
+            tail[:-1] |= mask[:-1] & change
+        starts = np.flatnonzero(head)
+        lengths = np.flatnonzero(tail) + 1 - starts
+
+    run_ids = ids[starts] if ids is not None else None
+    
+    return starts, lengths, run_ids
+
+
+
+def runs_to_mask(starts, lengths, size):
+    '''
+    Строит двоичную маску длины 'size', в которой отмечены последовательности 'starts', 'lengths' (обратно run_lengths).
+    '''
+
+    counter = np.zeros(size + 1, dtype='int64')
+    np.add.at(counter, starts, 1)
+    np.add.at(counter, starts + lengths, -1)
+    
+    return np.cumsum(counter[:-1]) > 0
+
+
+
+try:
+    from numba import njit
+
+    @njit(cache=True)
+    def _run_lengths_numba(mask, ids):
+        starts = np.empty(len(mask), dtype=np.int64)
+        lengths = np.empty(len(mask), dtype=np.int64)
+        k = 0
+        i = 0
+        n = len(mask)
+        while i < n:
+            if mask[i]:
+                j = i + 1
+                while j < n and mask[j] and ids[j] == ids[i]:
+                    j += 1
+                starts[k] = i
+                lengths[k] = j - i
+                k += 1
+                i = j
+            else:
+                i += 1
+        return starts[:k], lengths[:k]
+
+except ImportError:
+    _run_lengths_numba = None
+
+
+
 def absolute_limits_filtration(ser, ulim, blim, logger=None, inplace=False):
     '''
     Заменяет в 'ser' все значения, превышающие пороговые значения 'ulim', 'blim' на пустые (np.nan).
@@ -138,7 +420,7 @@ def absolute_limits_filtration(ser, ulim, blim, logger=None, inplace=False):
 
 
 
-def gates_filtration(ser, limit, df_bins=None, step=None, start=None, stop=None, logger=None, inplace=False):
+def gates_filtration(ser, limit, df_bins=None, step=None, start=None, stop=None, logger=None, inplace=False, return_counts=False):
     '''
     Осуществляет в 'ser' удаление значений лежащих за пределами "среднее значение +- 'limit'" по периодам осреднения 'df_bins'.
 
@@ -146,10 +428,11 @@ def gates_filtration(ser, limit, df_bins=None, step=None, start=None, stop=None,
     ----------
     ser : pd.DataFrame or pd.Series
         Входной датафрейм или временной ряд, содержащие данные, для которых будет производиться фильтрация воротами.
-    limit : int, float
-        Размер допустимого отклонения от среднего. 
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    limit : int, float or dict
+        Размер допустимого отклонения от среднего. Для pd.DataFrame можно задать словарь {колонка: limit}, 
+        колонки, отсутствующие в словаре, не фильтруются.
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -169,11 +452,17 @@ def gates_filtration(ser, limit, df_bins=None, step=None, start=None, stop=None,
     inplace : bool; optional
         Если False, сделает копию ser, если True перезапишет 'ser'.
         Default: False.  
+    return_counts : bool; optional
+        Если True, дополнительно возвращает количество удаленных значений в каждом периоде осреднения.
+        Default: False.
     
     Returns
     -------
     ser : pd.DataFrame or pd.Series
         Объект аналогичный 'ser' с пустыми значениями (np.nan) вместо пиков.
+    outliers_count : np.ndarray or pd.DataFrame
+        Возвращается, если 'return_counts' True. Для pd.Series - массив длины len(df_bins), 
+        для pd.DataFrame - таблица с индексом левых границ интервалов и колонками отфильтрованных величин.
 
     Функция поддерживает ввод 'ser' только в формате pd.DataFrame и pd.Series, если формат не соответсвует указанному, функция сообщит о несовпадении формата и вернет пустой вывод.
     Функция поддерживает как числовые, так и временные индексы 'ser'.
@@ -181,43 +470,43 @@ def gates_filtration(ser, limit, df_bins=None, step=None, start=None, stop=None,
     Для применения опции inplace, используйте ввод ser=df или ser = df['val']. Функция не перезапишет исходный 'ser', если использовать ввод ser = df[['val']], даже при inplace = True.   
     '''
     if isinstance(ser, pd.DataFrame):
-        return ser.apply(lambda x: drop_outliers(x, limit, df_bins, step, start, stop, logger, inplace))
-    
-    elif isinstance(ser, pd.Series):
         
         if not inplace: 
             ser = ser.copy()
         
-        if not df_bins:
-            df_bins = create_bins(ser, step, start, stop)
-            
-        # создает массивы границ превышений для каждого обрабатываемого периода осреднения
-        ser_mean = ser.groupby(df_bins, observed=False).mean()
-        ser_min = ser_mean - limit
-        ser_max = ser_mean + limit
-        ser_bins = ser_mean.index
+        df_bins = as_bin_index(df_bins, ser, step, start, stop)
 
-        # цикл по периодам осреднения
-        for bin, max, min in zip(ser_bins, ser_max, ser_min):
+        limits = limit if isinstance(limit, dict) else dict.fromkeys(ser.columns, limit)
+        columns = [column for column in ser.columns if column in limits]
 
-            # определяет маску превышений
-            mask = (ser[bin.left:bin.right] > max) | (ser[bin.left:bin.right] < min) 
-            
-            # находит начало и длину всех превышений
-            starts, lengths = find_start_and_lengt(mask)
+        # все колонки фильтруются за один проход
+        values = ser[columns].to_numpy(dtype='float64', copy=True)
+        outliers_count = _gates_mask(values, np.array([limits[column] for column in columns], dtype='float64'), df_bins)
+
+        for i, column in enumerate(columns):
+            ser[column] = values[:, i]
+            _log_outliers(logger, column, outliers_count[:, i], df_bins)
 
-            # цикл по превышениям
-            for start, length in zip(starts, lengths):
+        if return_counts:
+            return ser, pd.DataFrame(outliers_count, index=df_bins.left, columns=columns)
         
-                end = start + length
-                ser[bin.left:bin.right].iloc[start:end] = np.nan
+        return ser
     
-            # считает в периоде осреднения количесвто удаленных превышений 
-            outliers_count = np.sum(lengths)
+    elif isinstance(ser, pd.Series):
+        
+        if not inplace: 
+            ser = ser.copy()
+        
+        df_bins = as_bin_index(df_bins, ser, step, start, stop)
             
-            if logger and outliers_count > 0:
-                
-                logger.info(f'Value: {ser.name}, period: {bin}, outliers count: {outliers_count} ({np.round(outliers_count/len(ser[bin.left:bin.right])*100,2)}%)')
+        values = ser.to_numpy(dtype='float64', copy=True)
+        outliers_count = _gates_mask(values, limit, df_bins)
+        _log_outliers(logger, ser.name, outliers_count, df_bins)
+
+        ser.iloc[:] = values
+
+        if return_counts:
+            return ser, outliers_count
      
         return ser
     else: 
@@ -226,6 +515,30 @@ def gates_filtration(ser, limit, df_bins=None, step=None, start=None, stop=None,
 
 
 
+def _gates_mask(values, limit, df_bins):
+    '''
+    Заменяет на месте в 'values' (ряд или ряды по колонкам) значения за пределами "среднее +- 'limit'" на np.nan.
+    Возвращает количество удаленных значений по периодам осреднения.
+    '''
+
+    # границы превышений по периодам осреднения разворачиваются на все значения ряда, вне интервалов - np.nan
+    ser_mean = df_bins.broadcast(df_bins.mean(values))
+    with np.errstate(invalid='ignore'):
+        mask = (values > ser_mean + limit) | (values < ser_mean - limit)
+    values[mask] = np.nan
+
+    return df_bins.sum(mask.astype('float64')).astype('int64')
+
+
+
+def _log_outliers(logger, name, outliers_count, df_bins):
+    if logger:
+        for bin, count, total in zip(df_bins.intervals, outliers_count, df_bins.counts):
+            if count > 0:
+                logger.info(f'Value: {name}, period: {bin}, outliers count: {count} ({np.round(count/total*100,2)}%)')
+
+
+
 def sigmas_filtration(ser, nsig=3.5, n=3, iterations=3, df_bins=None, step=None, start=None, stop=None, logger=None, inplace=False):
     '''
     Осуществляет в 'ser' удаление значений лежащих за пределами "mean +- 'nsig' * std" по периодам осреднения 'df_bins'.
@@ -243,8 +556,8 @@ def sigmas_filtration(ser, nsig=3.5, n=3, iterations=3, df_bins=None, step=None,
     iterations : int; optional
         Количество итераций фильтраций. 
         Default: 3.
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -274,66 +587,281 @@ def sigmas_filtration(ser, nsig=3.5, n=3, iterations=3, df_bins=None, step=None,
     Функция поддерживает как числовые, так и временные индексы 'ser'.
     Функция поддреживает работу с 'ser', содержащими пропуски.
     Функция обрабатывает один и тот же период осреднения пока не достигнуто заданное количество итераций 'iterations' или пока все пики не будут удалены.
+    На каждой следующей итерации пересматриваются только периоды осреднения, в которых на предыдущей итерации были удалены значения, 
+    их среднее и стандартное отклонение обновляются вычитанием удаленных значений из накопленных сумм.
     Для применения опции inplace, используйте ввод ser=df или ser=df['val']. Функция не перезапишет исходный 'ser', если использовать ввод ser = df[['val']], даже при inplace = True.   
     '''
     
     if isinstance(ser, pd.DataFrame):
-        return ser.apply(lambda x: drop_spikes(x, nsig, n, iterations, df_bins, step, start, stop, logger, inplace))
+        
+        if not inplace: 
+            ser = ser.copy()
+        
+        df_bins = as_bin_index(df_bins, ser, step, start, stop)
+        
+        for column in ser:
+            ser[column] = sigmas_filtration(ser[column], nsig, n, iterations, df_bins, logger=logger)
+        
+        return ser
     
     elif isinstance(ser, pd.Series):
         
         if not inplace: 
             ser = ser.copy()
         
-        if not df_bins:
-            df_bins = create_bins(ser, step, start, stop)
+        df_bins = as_bin_index(df_bins, ser, step, start, stop)
+
+        values = ser.to_numpy(dtype='float64', copy=True)
+        ids = df_bins.ids
 
-        end_loop = True
+        # суммы по периодам осреднения считаются один раз относительно начального среднего (для устойчивости дисперсии), 
+        # затем из них вычитаются удаленные значения
+        shift = np.nan_to_num(df_bins.mean(values))
+        deviations = values - df_bins.broadcast(shift)
+        ser_count = df_bins.count(values)
+        ser_sum = df_bins.sum(deviations)
+        ser_sum2 = df_bins.sum(deviations ** 2)
+
+        # на каждой итерации обрабатываются только периоды осреднения, в которых на предыдущей итерации были удалены значения
+        active = ser_count > 0
         
         # цикл по итерациям
         for iteration in range(iterations):
+
+            bins = np.flatnonzero(active)
+            if not len(bins):
+                break
             
-            # создает массивы границ превышений для каждого обрабатываемого периода осреднения
-            ser_mean = ser.groupby(df_bins, observed=False).mean()
-            ser_std = ser.groupby(df_bins, observed=False).std()
+            # границы превышений для обрабатываемых периодов осреднения
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ser_mean = ser_sum / ser_count
+                ser_std = np.sqrt((ser_sum2 - ser_sum * ser_mean) / (ser_count - 1))
             ser_min = ser_mean - nsig * ser_std
             ser_max = ser_mean + nsig * ser_std
-            ser_bins = ser_mean.index
 
-            # цикл по периодам осреднения
-            for bin, max, min in zip(ser_bins, ser_max, ser_min):
+            # маска превышений строится сразу для всех значений обрабатываемых периодов осреднения
+            positions = df_bins.positions(bins)
+            y = deviations[positions]
+            y_ids = ids[positions]
+            with np.errstate(invalid='ignore'):
+                mask = (y > ser_max[y_ids]) | (y < ser_min[y_ids])
+
+            # находит начало, длину и период осреднения всех превышений, удаляет только короткие
+            starts, lengths, run_ids = run_lengths(mask, y_ids)
+            short = lengths <= n
+            removed = positions[runs_to_mask(starts[short], lengths[short], len(positions))]
+
+            # вычитает удаленные значения из сумм своих периодов осреднения
+            removed_ids = ids[removed]
+            removed_values = deviations[removed]
+            outliers_count = np.bincount(removed_ids, minlength=len(df_bins))
+            ser_count = ser_count - outliers_count
+            ser_sum = ser_sum - np.bincount(removed_ids, weights=removed_values, minlength=len(df_bins))
+            ser_sum2 = ser_sum2 - np.bincount(removed_ids, weights=removed_values ** 2, minlength=len(df_bins))
+            deviations[removed] = np.nan
+            values[removed] = np.nan
+
+            if logger:
+                for bin, count in zip(df_bins.intervals[outliers_count > 0], outliers_count[outliers_count > 0]):
+                    logger.info(f'Value: {ser.name}, period: {bin}, iteration {iteration+1}, spikes count: {count}')
+
+            active = outliers_count > 0
+
+        ser.iloc[:] = values
+                
+        return ser
+    
+    else: 
+        print(f'{type(ser)} - недопустимый формат ser. Аргумент ser должен быть pd.DataFrame или pd.Series')
+        return 
+
+
+
+def moving_sigmas_filtration(ser, window, nsig=3.5, n=3, iterations=20, nsig_step=0.1, logger=None, inplace=False):
+    '''
+    Осуществляет в 'ser' удаление значений лежащих за пределами "mean +- 'nsig' * std" скользящего окна (Vickers, Mahrt, 1997).
+    
+    Parameters
+    ----------
+    ser : pd.DataFrame or pd.Series
+        Входной датафрейм или временной ряд, содержащие данные, для которых будет производиться фильтрация пиков.
+    window : int
+        Ширина скользящего окна в количестве значений (например, 6000 для окна 5 мин при частоте 20 Гц). 
+        Окно центрировано на обрабатываемом значении и укорачивается у краев ряда.
+    nsig : int, float; optional
+        Размер допустимого отклонения от среднего окна в стандатных отклонениях окна на первой итерации. 
+        Default: 3.5.
+    n : int, float; optional
+        Если длина отклонения превышает 'n', пик считается значимым и не удаляется (как в sigmas_filtration).
+        Default: 3.
+    iterations : int; optional
+        Максимальное количество итераций фильтраций. 
+        Default: 20.
+    nsig_step : int, float; optional
+        Увеличение 'nsig' на каждой следующей итерации.
+        Default: 0.1.
+    logger : logging.Logger; optional
+        Если задан, записывает лог. 
+        Default: None.
+    inplace : bool; optional
+        Если False, сделает копию 'ser', если True, перезапишет 'ser'.
+        Default: False.  
+    
+    Returns
+    -------
+    ser : pd.DataFrame or pd.Series
+        Объект аналогичный 'ser' с пустыми значениями (np.nan) вместо пиков.
+    
+    В отличие от sigmas_filtration среднее и стандартное отклонение считаются не по периоду осреднения, а по окну вокруг 
+    каждого значения, поэтому медленные изменения внутри периода осреднения не принимаются за пики.
+    Скользящие среднее и дисперсия вычисляются по накопленным суммам за один проход по ряду, пропуски в окне не учитываются.
+    Итерации продолжаются, пока удаляются пики, но не более 'iterations'.
+    Функция поддерживает ввод 'ser' только в формате pd.DataFrame и pd.Series, если формат не соответсвует указанному, функция сообщит о несовпадении формата и вернет пустой вывод.
+    '''
+    
+    if isinstance(ser, pd.DataFrame):
+        
+        if not inplace: 
+            ser = ser.copy()
+        
+        for column in ser:
+            ser[column] = moving_sigmas_filtration(ser[column], window, nsig, n, iterations, nsig_step, logger=logger)
+        
+        return ser
+    
+    elif isinstance(ser, pd.Series):
+        
+        if not inplace: 
+            ser = ser.copy()
+
+        values = ser.to_numpy(dtype='float64', copy=True)
+        
+        # цикл по итерациям
+        for iteration in range(iterations):
+
+            ser_mean, ser_std = _rolling_mean_std(values, window)
+            limit = (nsig + iteration * nsig_step) * ser_std
+            with np.errstate(invalid='ignore'):
+                mask = np.abs(values - ser_mean) > limit
 
-                # определяет маску превышений
-                mask = (ser[bin.left:bin.right] > max)|(ser[bin.left:bin.right] < min)
+            # удаляет только короткие превышения, длинные считаются значимыми
+            starts, lengths, _ = run_lengths(mask)
+            short = lengths <= n
+            values[runs_to_mask(starts[short], lengths[short], len(values))] = np.nan
+            spikes_count = int(lengths[short].sum())
 
-                # находит начало и длину всех превышений
-                starts, lengths = find_start_and_lengt(mask)
+            if logger and spikes_count > 0:
+                logger.info(f'Value: {ser.name}, iteration {iteration+1}, spikes count: {spikes_count}')
 
-                outliers_count = 0
+            # если пиков не найдено, цикл заканчивается
+            if spikes_count == 0:
+                break
+
+        ser.iloc[:] = values
                 
-                # цикл по превышениям
-                for start, length in zip(starts, lengths):
-
-                    if length <= n:
-                        end = start + length
-                        ser[bin.left:bin.right].iloc[start:end] = np.nan
-                        outliers_count += length # считает в периоде осреднения количество обработанных значений
-                 
-                # если в периоде осреднения есть обработанные значения, флаг окончания итерационного цикла False, 
-                # если в периоде осреднения нет обработанных значений, переходим к следующему периоду 
-                if outliers_count > 0:
-                    end_loop = False
-                else:
-                    continue
+        return ser
+    
+    else: 
+        print(f'{type(ser)} - недопустимый формат ser. Аргумент ser должен быть pd.DataFrame или pd.Series')
+        return 
+
 
-                if logger:
-                    logger.info(f'Value: {ser.name}, period: {bin}, iteration {iteration+1}, spikes count: {outliers_count}')
-               
-            # если флаг окончания итерационного цикла True, цикл заканчивается, если False, меняется на True
-            if end_loop:
+
+def hampel_filtration(ser, window, nsig=3.5, n=3, iterations=1, resolution=0.01, logger=None, inplace=False):
+    '''
+    Осуществляет в 'ser' удаление значений лежащих за пределами "median +- 'nsig' * 1.4826 * MAD" скользящего окна (фильтр Хампеля).
+    
+    Parameters
+    ----------
+    ser : pd.DataFrame or pd.Series
+        Входной датафрейм или временной ряд, содержащие данные, для которых будет производиться фильтрация пиков.
+    window : int
+        Ширина скользящего окна в количестве значений. Окно центрировано на обрабатываемом значении и укорачивается у краев ряда.
+    nsig : int, float; optional
+        Размер допустимого отклонения от медианы окна в робастных стандатных отклонениях (1.4826 * MAD). 
+        Default: 3.5.
+    n : int, float; optional
+        Если длина отклонения превышает 'n', пик считается значимым и не удаляется (как в sigmas_filtration).
+        Default: 3.
+    iterations : int; optional
+        Максимальное количество итераций фильтраций. 
+        Default: 1.
+    resolution : int, float or dict; optional
+        Нижняя граница робастного стандартного отклонения (разрешение прибора). Для pd.DataFrame можно задать словарь 
+        {колонка: resolution}, для отсутствующих в словаре колонок граница не применяется.
+        Default: 0.01.
+    logger : logging.Logger; optional
+        Если задан, записывает лог. 
+        Default: None.
+    inplace : bool; optional
+        Если False, сделает копию 'ser', если True, перезапишет 'ser'.
+        Default: False.  
+    
+    Returns
+    -------
+    ser : pd.DataFrame or pd.Series
+        Объект аналогичный 'ser' с пустыми значениями (np.nan) вместо пиков.
+    
+    На квантованных данных (шаг 0.01 у АМК-04 и кэша int16) MAD в окне часто равен нулю, и без нижней границы пиком 
+    считалось бы любое значение, отличное от медианы. Поэтому порог считается как 'nsig' * max(1.4826 * MAD, 'resolution'), 
+    количество значений, для которых применена граница, записывается в лог.
+    Медиана и MAD устойчивы к группам пиков внутри окна, в отличие от среднего и стандартного отклонения (см. sigmas_filtration, 
+    moving_sigmas_filtration). MAD считается как скользящая медиана модуля отклонений от скользящей медианы.
+    Скользящая медиана вычисляется pandas (rolling().median(), упорядоченное окно на skiplist, без сортировки каждого окна), 
+    для pd.DataFrame - сразу для всех колонок, пропуски в окне не учитываются.
+    Функция поддерживает ввод 'ser' только в формате pd.DataFrame и pd.Series, если формат не соответсвует указанному, функция сообщит о несовпадении формата и вернет пустой вывод.
+    '''
+    
+    if isinstance(ser, (pd.DataFrame, pd.Series)):
+        
+        if not inplace: 
+            ser = ser.copy()
+
+        frame = ser.to_frame() if isinstance(ser, pd.Series) else ser
+        values = frame.to_numpy(dtype='float64', copy=True)
+        active = np.ones(values.shape[1], dtype=bool)
+        resolutions = resolution if isinstance(resolution, dict) else dict.fromkeys(frame.columns, resolution)
+        floor = np.array([resolutions.get(column, 0) for column in frame.columns], dtype='float64')
+
+        # цикл по итерациям
+        for iteration in range(iterations):
+
+            columns = np.flatnonzero(active)
+            if not len(columns):
                 break
-            else:
-                end_loop = True
+
+            # скользящие медиана и MAD для всех еще обрабатываемых колонок за один вызов
+            y = pd.DataFrame(values[:, columns])
+            median = y.rolling(window, center=True, min_periods=1).median()
+            deviation = (y - median).abs()
+            sigma = 1.4826 * deviation.rolling(window, center=True, min_periods=1).median().to_numpy()
+            with np.errstate(invalid='ignore'):
+                floored = sigma < floor[columns]
+                masks = deviation.to_numpy() > nsig * np.where(floored, floor[columns], sigma)
+
+            for i, mask, floored_count in zip(columns, masks.T, floored.sum(axis=0)):
+
+                if logger and floored_count > 0:
+                    logger.info(f'Value: {frame.columns[i]}, iteration {iteration+1}, MAD below resolution: {floored_count} values, ' 
+                                f'{np.round(floored_count/len(values)*100, 2)} %')
+
+                # удаляет только короткие превышения, длинные считаются значимыми
+                starts, lengths, _ = run_lengths(mask)
+                short = lengths <= n
+                values[runs_to_mask(starts[short], lengths[short], len(values)), i] = np.nan
+                spikes_count = int(lengths[short].sum())
+
+                if logger and spikes_count > 0:
+                    logger.info(f'Value: {frame.columns[i]}, iteration {iteration+1}, spikes count: {spikes_count}')
+
+                # колонка без пиков больше не обрабатывается
+                active[i] = spikes_count > 0
+
+        if isinstance(ser, pd.Series):
+            ser.iloc[:] = values[:, 0]
+        else:
+            for i, column in enumerate(ser.columns):
+                ser[column] = values[:, i]
                 
         return ser
     
@@ -343,7 +871,36 @@ def sigmas_filtration(ser, nsig=3.5, n=3, iterations=3, df_bins=None, step=None,
 
 
 
-def detrend(ser, df_bins=None, step=None, start=None, stop=None, mode='detrend', min_val=3, logger=None, inplace=False):
+def _rolling_mean_std(values, window):
+    '''
+    Среднее и стандартное отклонение (ddof=1) в центрированном окне шириной 'window' по накопленным суммам, без учета пропусков.
+    '''
+
+    valid = np.isfinite(values)
+    # отклонения от общего среднего уменьшают потерю точности при вычитании накопленных сумм
+    offset = np.nanmean(values) if valid.any() else 0.0
+    deviations = np.where(valid, values - offset, 0.0)
+
+    cumcount = np.concatenate([[0], np.cumsum(valid)])
+    cumsum = np.concatenate([[0.0], np.cumsum(deviations)])
+    cumsum2 = np.concatenate([[0.0], np.cumsum(deviations ** 2)])
+
+    positions = np.arange(len(values))
+    lo = np.clip(positions - window // 2, 0, len(values))
+    hi = np.clip(positions - window // 2 + window, 0, len(values))
+
+    count = cumcount[hi] - cumcount[lo]
+    total = cumsum[hi] - cumsum[lo]
+    total2 = cumsum2[hi] - cumsum2[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = np.maximum(total2 - total * mean, 0.0) / (count - 1)
+
+    return mean + offset, np.sqrt(var)
+
+
+
+def detrend(ser, df_bins=None, step=None, start=None, stop=None, mode='detrend', min_val=3, tau=200, restart=False, logger=None, inplace=False, return_params=False):
     '''
     Осуществялет удаление тренда из данных 'ser' по периодам осреднения 'df_bins'.
     
@@ -351,8 +908,8 @@ def detrend(ser, df_bins=None, step=None, start=None, stop=None, mode='detrend',
     ----------
     ser : pd.DataFrame or pd.Series
         Входной датафрейм или таймсерия, содержащие данные, для которых будет производиться детрендинг.
-    df_bins : pandas.core.arrays.categorical.Categorical; optional
-        Объект, содержащий границы интервалов осреднения. Если не задан, используются 'step', 'start', 'stop'.  
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
         Default: None.
     step : int, float, Timedelta; optional
         Длина интервала осреднения. 
@@ -366,118 +923,344 @@ def detrend(ser, df_bins=None, step=None, start=None, stop=None, mode='detrend',
         Конец обрабатываемого периода. 
         Используется, если не задан 'df_bins'. Если None, берется последний индекс 'ser' (не рекомендуется, см. create_bins).
         Default: None.
-    mode : {'trend', 'detrend', 'dwm'}; optional
+    mode : {'trend', 'detrend', 'dwm', 'running_mean', 'rmwm', 'block'}; optional
         Удаляет тренд, если mode = 'detrend'. Сохряняет только вычисленный тренд, если mode = 'trend'.
         Вычитает тренд, но оставляет среднее, если mode = 'dwm'.  
+        Вычитает скользящее (экспоненциальное) среднее с постоянной времени 'tau', если mode = 'running_mean'.
+        Вычитает скользящее среднее, но оставляет среднее за период осреднения, если mode = 'rmwm'.
+        Вычитает среднее за период осреднения (блочное осреднение), если mode = 'block'.
         Default: 'detrend'. 
     min_val: int; optional
         Минимальное количество непустых значений за период осреднения. Если значений меньше, весь период заполняется np.nan. 
         Default: 3.
+    tau : int, float or list; optional
+        Постоянная времени скользящего среднего [с] (для числового индекса - в единицах индекса) для mode = 'running_mean', 'rmwm'.
+        Если задан список, ряд фильтруется для каждой постоянной времени, см. Returns.
+        Default: 200.
+    restart : bool; optional
+        Если True, скользящее среднее начинается заново в каждом периоде осреднения, иначе считается по всему ряду.
+        Default: False.
     logger : logging.Logger; optional
         Если задан, записывает лог. 
         Default: None.
     inplace : bool; optional
         Если False, сделает копию 'ser', если True перезапишет 'ser'.
         Default: False.
+    return_params : bool; optional
+        Если True, дополнительно возвращает таблицу параметров тренда.
+        Default: False.
     
     Returns
     -------
     ser_detrend : pd.DataFrame or pd.Series
         Объект аналогичный 'ser' c преобразованным трендом.
+        Если 'tau' - список, возвращается новый pd.DataFrame с колонками по постоянным времени 
+        (для pd.DataFrame - двухуровневые колонки (tau, колонка)), 'inplace' не применяется.
+    df_params : pd.DataFrame
+        Возвращается, если 'return_params' True, для mode = 'trend', 'detrend', 'dwm' (иначе None). Таблица с индексом левых границ интервалов и колонками 'slope', 'intercept' 
+        (для pd.DataFrame - для каждой колонки 'ser', двухуровневые колонки). Наклон задан на одно значение ряда, 
+        отсчет ведется от первого значения периода осреднения. Для периодов с количеством значений меньше 'min_val' - np.nan.
     
     Функция поддерживает ввод 'ser' только в формате pd.DataFrame и pd.Series, если формат не соответсвует указанному, функция сообщит о несовпадении формата и вернет пустой вывод.
     Функция поддерживает как числовые, так и временные индексы 'ser'.
     Функция поддреживает работу с 'ser', содержащими пропуски.
+    Параметры тренда всех периодов осреднения (и всех колонок pd.DataFrame) вычисляются сразу по суммам x, y, xy, x^2 (см. trend_parameters).
+    Скользящее среднее вычисляется рекурсивным фильтром m[i] = a * m[i-1] + (1 - a) * x[i], a = exp(-dt / 'tau') за один проход 
+    (scipy.signal.lfilter), пропуски исключаются нормировкой на тот же фильтр, примененный к маске непустых значений.
     Для применения опции 'inplace', используйте ввод ser = df или ser = df['val']. Функция не перезапишет исходный 'ser', если использовать ввод ser = df[['val']], даже при inplace = True.   
     
     '''
-    if isinstance(ser, pd.DataFrame):
-        return ser.apply(lambda x: detrend(x, df_bins, step, start, stop, mode, min_val, logger, inplace))
-    
-    elif isinstance(ser, pd.Series):
-    
-        if not inplace:
+    if isinstance(ser, (pd.DataFrame, pd.Series)):
+        
+        if not inplace: 
             ser = ser.copy()
         
-        if not df_bins:
-            df_bins = create_bins(ser, step, start, stop)
+        df_bins = as_bin_index(df_bins, ser, step, start, stop)
 
-        ser_mean = ser.groupby(df_bins, observed=False).mean()
-        ser_count = ser.groupby(df_bins, observed=False).count()
-        ser_bins = ser_mean.index
-        
-        for bin, count, mean in zip(ser_bins, ser_count, ser_mean):
+        frame = ser.to_frame() if isinstance(ser, pd.Series) else ser
+        values = frame.to_numpy(dtype='float64', copy=True)
+        inside = df_bins.ids >= 0
 
-            if count >= min_val:
+        if mode in ('running_mean', 'rmwm', 'block'):
 
-                y = ser[bin.left:bin.right]
-                x = np.arange(len(y))
+            ser_mean = df_bins.mean(values)
+            ser_count = df_bins.count(values)
+            ser_mean[ser_count < min_val] = np.nan
 
-                not_nan = np.logical_not(np.isnan(y))
+            if mode == 'block':
+                values[inside] -= ser_mean[df_bins.ids[inside]]
+                filtered = {None: values}
+            else:
+                a = {t: np.exp(-_sampling_interval(ser.index) / t) for t in np.atleast_1d(tau)}
+                filtered = {}
+                for t in a:
+                    y = values - running_mean(values, a[t], df_bins if restart else None)
+                    if mode == 'rmwm':
+                        y[inside] += ser_mean[df_bins.ids[inside]]
+                    # периоды осреднения, в которых меньше 'min_val' значений, заполняются np.nan, значения вне периодов не изменяются
+                    y[inside] = np.where((ser_count < min_val)[df_bins.ids[inside]], np.nan, y[inside])
+                    y[~inside] = values[~inside]
+                    filtered[t] = y
+
+            if np.ndim(tau) and mode != 'block':
+                if isinstance(ser, pd.Series):
+                    ser_filtered = pd.DataFrame({t: y[:, 0] for t, y in filtered.items()}, index=ser.index)
+                else:
+                    ser_filtered = pd.concat({t: pd.DataFrame(y, index=ser.index, columns=ser.columns) for t, y in filtered.items()}, axis=1)
+                if return_params:
+                    return ser_filtered, None
+                return ser_filtered
 
-                slope, intercept, r_value, p_value, std_err = stats.linregress(x[not_nan], y[not_nan])
-                
-                if logger:
-                    logger.info(f'Value: {ser.name}, period: {bin}, slope {slope}, intercept {intercept}')
+            values = next(iter(filtered.values()))
+            slope = intercept = None
 
-                trend = slope * x + intercept
-                
-                if mode == 'trend': 
-                    ser[bin.left:bin.right] = trend
-                elif mode == 'dwm': 
-                    ser[bin.left:bin.right] = y - trend + mean   
-                else: 
-                    ser[bin.left:bin.right] = y - trend
-                    
+        else:
+
+            slope, intercept, ser_mean, ser_count = trend_parameters(values, df_bins)
+            slope[ser_count < min_val] = np.nan
+            intercept[ser_count < min_val] = np.nan
+
+            if logger:
+                for i, column in enumerate(frame.columns):
+                    for bin, sl, ic in zip(df_bins.intervals, slope[:, i], intercept[:, i]):
+                        if np.isfinite(sl):
+                            logger.info(f'Value: {column}, period: {bin}, slope {sl}, intercept {ic}')
+
+            # тренд разворачивается на все значения периодов осреднения, значения вне периодов не изменяются
+            x = _bin_positions(df_bins)[inside, None]
+            trend = slope[df_bins.ids[inside]] * x + intercept[df_bins.ids[inside]]
+            
+            if mode == 'trend': 
+                values[inside] = trend
+            elif mode == 'dwm': 
+                values[inside] -= trend - ser_mean[df_bins.ids[inside]]
+            else: 
+                values[inside] -= trend
+        
+        if isinstance(ser, pd.Series):
+            ser.iloc[:] = values[:, 0]
+        else:
+            for i, column in enumerate(ser.columns):
+                ser[column] = values[:, i]
+
+        if return_params:
+            if slope is None:
+                df_params = None
+            elif isinstance(ser, pd.Series):
+                df_params = pd.DataFrame({'slope': slope[:, 0], 'intercept': intercept[:, 0]}, index=df_bins.left)
             else:
-                ser[bin.left:bin.right] = np.nan
+                df_params = pd.concat({column: pd.DataFrame({'slope': slope[:, i], 'intercept': intercept[:, i]}, index=df_bins.left) 
+                                       for i, column in enumerate(ser.columns)}, axis=1)
+            return ser, df_params
         
         return ser
     
     else: 
-        logger.error(f'{type(ser)} - недопустимый формат ser. Аргумент ser должен быть pd.DataFrame или pd.Series')
+        print(f'{type(ser)} - недопустимый формат ser. Аргумент ser должен быть pd.DataFrame или pd.Series')
         return
 
 
 
-def fillgaps(ser, inplace=False):
-    if inplace:
-        ser.interpolate(inplace=inplace)
-    else: 
-        return ser.interpolate()
+def trend_parameters(values, df_bins):
+    '''
+    Вычисляет линейный тренд (МНК) 'values' (1D или 2D по колонкам) во всех интервалах осреднения 'df_bins' сразу.
+
+    Returns
+    -------
+    slope, intercept, mean, count : np.ndarray
+        Наклон и свободный член тренда, среднее и количество непустых значений, размер (n_bins, колонки).
+        Аргумент тренда - номер значения внутри интервала осреднения (с 0), пропуски не учитываются.
+    '''
+
+    values = np.asarray(values, dtype='float64')
+    if values.ndim == 1:
+        values = values[:, None]
+
+    ser_mean = df_bins.mean(values)
+    ser_count = df_bins.count(values)
+
+    # суммы считаются по отклонениям от среднего периода осреднения, это уменьшает потерю точности
+    x = _bin_positions(df_bins)[:, None]
+    y = values - df_bins.broadcast(ser_mean)
+    x_valid = np.where(np.isfinite(y), x, np.nan)
+    sx = df_bins.sum(x_valid)
+    sxx = df_bins.sum(x_valid ** 2)
+    sy = df_bins.sum(y)
+    sxy = df_bins.sum(x_valid * y)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (ser_count * sxy - sx * sy) / (ser_count * sxx - sx ** 2)
+        intercept = (sy - slope * sx) / ser_count + ser_mean
+
+    return slope, intercept, ser_mean, ser_count
+
+
+
+def running_mean(values, a, df_bins=None):
+    '''
+    Скользящее экспоненциальное среднее m[i] = a * m[i-1] + (1 - a) * x[i] значений 'values' (1D или 2D по колонкам) 
+    за один проход рекурсивного фильтра (scipy.signal.lfilter).
+
+    Пропуски не учитываются: фильтр применяется к значениям с нулями вместо пропусков и к маске непустых значений, 
+    среднее - их отношение. Если задан 'df_bins', фильтр начинается заново в каждом периоде осреднения 
+    (через to_grid), значения вне периодов - np.nan.
+    '''
+
+    values = np.asarray(values, dtype='float64')
+    valid = np.isfinite(values)
+    b, a = [1 - a], [1, -a]
+
+    if df_bins is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return signal.lfilter(b, a, np.where(valid, values, 0.0), axis=0) / signal.lfilter(b, a, valid, axis=0)
+
+    grid = df_bins.to_grid(values)
+    grid_valid = np.isfinite(grid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grid = signal.lfilter(b, a, np.where(grid_valid, grid, 0.0), axis=1) / signal.lfilter(b, a, grid_valid, axis=1)
     
-    # # цикл по периодам осреднения
-    # for bin in df_bins:
+    return df_bins.from_grid(grid, np.full_like(values, np.nan))
 
-    #     # определяет маску превышений
-    #     mask = ser[bin.left:bin.right].isna()
 
-    #     # находит начало и длину всех превышений
-    #     starts, lengths = find_start_and_lengt(ser[bin.left:bin.right], mask)
 
-        
-    #     # цикл по превышениям
-    #     for start, length in zip(starts, lengths):
+def _sampling_interval(index):
+    '''
+    Медианный шаг индекса ряда: в секундах для временного индекса, в единицах индекса для числового.
+    '''
+    if isinstance(index, pd.DatetimeIndex):
+        return (index[1:] - index[:-1]).median().total_seconds()
+    return np.median(np.diff(np.asarray(index, dtype='float64')))
 
-    #         if length == 1:
-    #             ser[bin.left:bin.right].iloc[start] = (ser[bin.left:bin.right].iloc[start-length]+ser[bin.left:bin.right].iloc[start+length])/2
-    #         else:
-    #             end = start + length
-                
-    #             y = ser[bin.left:bin.right].iloc[start-length:end+length]
-    #             x = np.arange(len(y))
 
-    #             gap = np.isnan(y)
-    #             not_gap = np.logical_not(gap)
 
-    #             slope, intercept, _, _, _ = stats.linregress(x[not_gap], y[not_gap])
-                
-    #             if logger:
-    #                 logger.info(f'Value: {ser.name}, period: {bin}, slope {slope}, intercept {intercept}')
+def _bin_positions(df_bins):
+    '''
+    Номер каждого значения ряда внутри своего интервала осреднения (с 0), np.nan вне интервалов.
+    '''
+    return np.arange(len(df_bins.ids)) - df_bins.broadcast(df_bins.starts)
+
 
-    #             ser[bin.left:bin.right].iloc[start:end] = slope * x[gap] + intercept
 
-    # return ser
+def fillgaps(ser, inplace=False, max_gap=None, df_bins=None, step=None, start=None, stop=None, logger=None, return_counts=False):
+    '''
+    Заполняет пропуски в 'ser' линейной интерполяцией по соседним значениям внутри периодов осреднения 'df_bins'.
+    
+    Parameters
+    ----------
+    ser : pd.DataFrame or pd.Series
+        Входной датафрейм или временной ряд, содержащие пропуски.
+    inplace : bool; optional
+        Если False, сделает копию 'ser', если True перезапишет 'ser'. Остается вторым аргументом для совместимости 
+        с прежним вызовом fillgaps(ser, inplace).
+        Default: False.
+    max_gap : int; optional
+        Максимальная длина заполняемого пропуска (количество подряд идущих пропущенных значений). 
+        Более длинные пропуски не заполняются. Если None, длина не ограничена.
+        Default: None.
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не заданы 'df_bins' и 'step', 
+        пропуски заполняются по всему ряду без учета периодов осреднения.  
+        Default: None.
+    step : int, float, Timedelta; optional
+        Длина интервала осреднения. 
+        Используется, если не задан 'df_bins'.
+        Default: None.
+    start : int, float, Timestamp; optional
+        Начало обрабатываемого периода. 
+        Используется, если не задан 'df_bins'. Если None, берется первый индекс 'ser' (не рекомендуется, см. create_bins). 
+        Default: None.
+    stop : int, float, Timestamp; optional
+        Конец обрабатываемого периода. 
+        Используется, если не задан 'df_bins'. Если None, берется последний индекс 'ser' (не рекомендуется, см. create_bins).
+        Default: None.
+    logger : logging.Logger; optional
+        Если задан, записывает лог. 
+        Default: None.
+    return_counts : bool; optional
+        Если True, дополнительно возвращает количество непустых значений в каждом периоде осреднения до и после заполнения
+        (в формате dq.counts). Требует 'df_bins' или 'step', иначе вызывает ValueError.
+        Default: False.
+    
+    Returns
+    -------
+    ser : pd.DataFrame or pd.Series
+        Объект аналогичный 'ser' с заполненными пропусками.
+    counts_before, counts_after : pd.DataFrame or pd.Series
+        Возвращаются, если 'return_counts' True.
+
+    Заполняются только пропуски, с обеих сторон которых есть значения того же периода осреднения: интерполяция не переходит 
+    через границы периодов, пропуски в начале и в конце периода не заполняются. Значения вне периодов осреднения не изменяются.
+    Интерполяция линейна по номеру значения (как ser.interpolate()).
+    Все пропуски находятся за один проход (см. run_lengths) и заполняются без цикла по периодам осреднения.
+    '''
+
+    if isinstance(ser, (pd.DataFrame, pd.Series)):
+
+        if return_counts and df_bins is None and step is None:
+            raise ValueError("Для return_counts = True необходимо задать 'df_bins' или 'step'")
+        
+        if not inplace: 
+            ser = ser.copy()
+        
+        if df_bins is not None or step is not None:
+            df_bins = as_bin_index(df_bins, ser, step, start, stop)
+            ids = df_bins.ids
+        else:
+            ids = np.zeros(len(ser), dtype='int32')
+
+        frame = ser.to_frame() if isinstance(ser, pd.Series) else ser
+        values = frame.to_numpy(dtype='float64', copy=True)
+        if return_counts:
+            counts_before = df_bins.count(values)
+        filled = np.zeros((len(df_bins) if return_counts else 0, values.shape[1]))
+
+        for i, column in enumerate(frame.columns):
+
+            y = values[:, i]
+            
+            # находит все пропуски, разделенные на границах периодов осреднения
+            starts, lengths, run_ids = run_lengths(np.isnan(y), ids)
+            ends = starts + lengths
+
+            # заполняются пропуски, у которых есть значения того же периода с обеих сторон и длина не больше 'max_gap'
+            fill = (starts > 0) & (ends < len(y))
+            fill[fill] &= (ids[starts[fill] - 1] == run_ids[fill]) & (ids[np.minimum(ends[fill], len(y) - 1)] == run_ids[fill])
+            if max_gap is not None:
+                fill &= lengths <= max_gap
+            starts, lengths, ends, run_ids = starts[fill], lengths[fill], ends[fill], run_ids[fill]
+
+            # линейная интерполяция между значениями на концах каждого пропуска
+            left = y[starts - 1]
+            right = y[ends]
+            gap = np.repeat(np.arange(len(starts)), lengths)
+            offset = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 1
+            y[np.repeat(starts, lengths) + offset - 1] = left[gap] + (right[gap] - left[gap]) * offset / (lengths[gap] + 1)
+
+            if return_counts:
+                filled[:, i] = np.bincount(run_ids, weights=lengths, minlength=len(df_bins))
+
+            if logger and len(starts):
+                logger.info(f'Value: {column}, gaps filled: {len(starts)}, values filled: {lengths.sum()}')
+
+        if isinstance(ser, pd.Series):
+            ser.iloc[:] = values[:, 0]
+        else:
+            for i, column in enumerate(ser.columns):
+                ser[column] = values[:, i]
+
+        if return_counts:
+            # для pd.Series таблицы счетчиков - pd.Series с тем же именем, что и 'ser' (в том числе None)
+            if isinstance(ser, pd.Series):
+                counts_before, filled = counts_before[:, 0], filled[:, 0]
+            counts_before = df_bins.to_frame(counts_before.astype('int64'), ser)
+            counts_after = counts_before + df_bins.to_frame(filled.astype('int64'), ser)
+            return ser, counts_before, counts_after
+        
+        return ser
+    
+    else: 
+        print(f'{type(ser)} - недопустимый формат ser. Аргумент ser должен быть pd.DataFrame или pd.Series')
+        return
 
 
 
@@ -492,6 +1275,9 @@ def axis_rotations(df, D=2, df_bins=None, step=None, start=None, stop=None, u_na
     D : int; optional
         Количество поворотов осей. Для измерений над неоднородной поверхностью рекомендуется использовать 1 или 2 поворота (Finnigan, 2004)
         Default: 2.
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
+        Default: None.
     step : int, float, Timedelta
         Длина интервала осреднения.
     start : int, float, Timestamp; optional
@@ -522,6 +1308,10 @@ def axis_rotations(df, D=2, df_bins=None, step=None, start=None, stop=None, u_na
         Датафрейм идентичный df, содержащий развернутые компоненты скорости u, v, w.
     angles : pd.DataFrame
         Датафрейм, содержащий углы поворота для каждого вектора скорости за все периоды осреднения.
+
+    Углы всех поворотов находятся по средним и ковариациям u, v, w за периоды осреднения, вычисленным за один проход 
+    по значениям, где известны все три компоненты. Третий угол 'Psi' обнуляет ковариацию v'w' после двух первых поворотов.
+    Все повороты объединяются в одну матрицу на период осреднения, которая применяется к значениям одной операцией.
     '''
     
     if not inplace:
@@ -532,43 +1322,255 @@ def axis_rotations(df, D=2, df_bins=None, step=None, start=None, stop=None, u_na
             logger.error("Недопустимое количество поворотов осей, 'D' должно быть от 1 до 3.")
         return
     
-    angles = pd.DataFrame()
-
-    if not df_bins:
-        df_bins = create_bins(ser, step, start, stop)
+    df_bins = as_bin_index(df_bins, df, step, start, stop)
+    inside = df_bins.ids >= 0
+    ids = df_bins.ids[inside]
+
+    # средние и ковариации компонент скорости считаются за один проход по значениям, где известны все три компоненты
+    velocity = df[[u_name, v_name, w_name]].to_numpy(dtype='float64')
+    velocity = np.where(np.isfinite(velocity).all(axis=1)[:, None], velocity, np.nan)
+    mean = df_bins.mean(velocity)
+    if D == 3:
+        # ковариации считаются по одной паре компонент, без массива попарных произведений на все значения
+        deviations = velocity - df_bins.broadcast(mean)
+        cov = np.empty((len(df_bins), 3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                cov[:, i, j] = cov[:, j, i] = df_bins.mean(deviations[:, i] * deviations[:, j])
+
+    # углы каждого следующего поворота находятся по средним (и ковариациям), развернутым матрицей предыдущих поворотов,
+    # поэтому промежуточные повороты данных не нужны
+    angles = pd.DataFrame(index=df_bins.left)
+    matrix = np.broadcast_to(np.eye(3), (len(df_bins), 3, 3))
     
     if D >= 1:
-        df_mean = df[[u_name, v_name]].groupby(df_bins, observed=False).mean()
-        angles['Theta'] = np.arctan(df_mean[v_name] / df_mean[u_name])
-                          
-        rotation(df, u_name, v_name, angles.Theta)
+        angles['Theta'] = np.arctan(mean[:, 1] / mean[:, 0])
+        matrix = _rotation_matrix(angles.Theta.to_numpy(), 0, 1) @ matrix
         if logger:
             logger.info("Поворот вокруг оси 'z' выполнен.")
         
     if D >= 2:
-        df_mean = df[[u_name, w_name]].groupby(df_bins, observed=False).mean()
-        angles['Phi'] = np.arctan(df_mean[w_name] / df_mean[u_name])                
-        
-        rotation(df, u_name, w_name, angles.Phi)
+        rotated_mean = np.einsum('nij,nj->ni', matrix, mean)
+        angles['Phi'] = np.arctan(rotated_mean[:, 2] / rotated_mean[:, 0])                
+        matrix = _rotation_matrix(angles.Phi.to_numpy(), 0, 2) @ matrix
         if logger:
             logger.info("Поворот вокруг оси 'y' выполнен.")
     
-    # if D == 3:
-    #     u1u2 = stat_moments(df[[v_name, w_name]], df_bins)
-    #     u1u1 = stat_moments(df[[v_name, v_name]], df_bins)
-    #     u2u2 = stat_moments(df[[w_name, w_name]], df_bins)
-    #     angles['Psi'] = 0.5 * np.arctan(2 * u1u2, (u1u1 - u2u2))
-                                 
-    #     rotation(df, v_name, w_name, angles.Psi)
-    #     log.info("Поворот вокруг оси 'x' выполнен.")
+    if D == 3:
+        rotated_cov = matrix @ cov @ matrix.transpose(0, 2, 1)
+        angles['Psi'] = 0.5 * np.arctan2(2 * rotated_cov[:, 1, 2], rotated_cov[:, 1, 1] - rotated_cov[:, 2, 2])
+        matrix = _rotation_matrix(angles.Psi.to_numpy(), 1, 2) @ matrix
+        if logger:
+            logger.info("Поворот вокруг оси 'x' выполнен.")
+
+    # итоговая матрица поворота каждого периода осреднения применяется ко всем его значениям одной операцией, 
+    # значения вне периодов осреднения не изменяются
+    velocity = df[[u_name, v_name, w_name]].to_numpy(dtype='float64', copy=True)
+    velocity[inside] = np.einsum('nij,nj->ni', matrix[ids], velocity[inside])
+    for i, name in enumerate([u_name, v_name, w_name]):
+        df[name] = velocity[:, i]
     
-    angles.index = angles.index.categories.left
+    return df, angles
+
+
+
+def _rotation_matrix(angles, i, j):
+    '''
+    Матрицы (n_bins, 3, 3) поворота на углы 'angles' в плоскости компонент 'i', 'j' (как в rotation).
+    '''
+    sin = np.sin(angles)
+    cos = np.cos(angles)
+    matrix = np.zeros((len(angles), 3, 3))
+    matrix[:, 0, 0] = matrix[:, 1, 1] = matrix[:, 2, 2] = 1
+    matrix[:, i, i] = cos
+    matrix[:, i, j] = sin
+    matrix[:, j, i] = -sin
+    matrix[:, j, j] = cos
+    return matrix
+
+
+
+def planar_fit(df_means, sectors=1, u_name='u', v_name='v', w_name='w', min_periods=10):
+    '''
+    Находит коэффициенты плоскости w = b0 + b1 * u + b2 * v по средним компонентам скорости за периоды осреднения (Wilczak et al., 2001).
+    
+    Parameters
+    ----------
+    df_means : pd.DataFrame
+        Средние значения компонент скорости за периоды осреднения до поворота осей (после фильтрации), 
+        по возможности за длительный срок (месяцы) без изменения положения прибора: ec.means до axis_rotations, 
+        таблица 'unrotated_means' ecliblight.processing или колонки 'u_unrot', 'v_unrot', 'w_unrot' таблицы моментов eclibmain 
+        (задайте 'u_name', 'v_name', 'w_name'). Средние после axis_rotations (колонки 'u', 'v', 'w' таблицы моментов) не подходят: 
+        средние v и w в них равны нулю по построению, и плоскость вырождается.
+    sectors : int; optional
+        Количество равных секторов направления ветра, для каждого из которых плоскость находится отдельно.
+        Default: 1.
+    u_name : str; optional
+        Название колонки df_means, содержащей компоненту скорости u.
+        Default: 'u'.
+    v_name : str; optional
+        Название колонки df_means, содержащей компоненту скорости v.
+        Default: 'v'.
+    w_name : str; optional
+        Название колонки df_means, содержащей компоненту скорости w.
+        Default: 'w'.
+    min_periods : int; optional
+        Минимальное количество периодов осреднения в секторе. Для секторов с меньшим количеством коэффициенты - np.nan.
+        Default: 10.
+        
+    Returns
+    -------
+    df_fit : pd.DataFrame
+        Таблица с индексом начала сектора [°] (направление, откуда дует ветер, как calculation.wind_dir) 
+        и колонками 'b0', 'b1', 'b2', 'count'.
+    '''
+
+    means = df_means[[u_name, v_name, w_name]].to_numpy(dtype='float64')
+    means = means[np.isfinite(means).all(axis=1)]
+
+    width = 360 / sectors
+    sector = _wind_sector(means[:, 0], means[:, 1], sectors)
+
+    fit = np.full((sectors, 3), np.nan)
+    count = np.bincount(sector, minlength=sectors)
+    for i in np.flatnonzero(count >= min_periods):
+        x = means[sector == i]
+        A = np.column_stack([np.ones(len(x)), x[:, 0], x[:, 1]])
+        fit[i] = np.linalg.lstsq(A, x[:, 2], rcond=None)[0]
+
+    df_fit = pd.DataFrame(fit, index=np.arange(sectors) * width, columns=['b0', 'b1', 'b2'])
+    df_fit['count'] = count
+
+    return df_fit
+
+
+
+def planar_fit_rotations(df, df_fit, df_bins=None, step=None, start=None, stop=None, u_name='u', v_name='v', w_name='w', logger=None, inplace=False):
+    '''
+    Поворачивает оси компонент скорости ветра методом планарной аппроксимации (planar fit, Wilczak et al., 2001) по периодам осреднения 'df_bins'.
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame, содержащий компоненты скорости u, v, w.  
+    df_fit : pd.DataFrame
+        Коэффициенты плоскости по секторам направления ветра (см. planar_fit).
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан, используются 'step', 'start', 'stop'.  
+        Default: None.
+    step : int, float, Timedelta
+        Длина интервала осреднения.
+    start : int, float, Timestamp; optional
+        Начало обрабатываемого периода. Если неуказано, берется первый индекс df (не рекомендуется, см. bins).
+        Default: None.
+    stop : int, float, Timestamp; optional
+        Конец обрабатываемого периода. Если неуказано, берется последний индекс df (не рекомендуется, см. bins).
+        Default: None.
+    u_name : str; optional
+        Название колонки df, содержащей компоненту скорости u.
+        Default: 'u'.
+    v_name : str; optional
+        Название колонки df, содержащей компоненту скорости v.
+        Default: 'v'.
+    w_name : str; optional
+        Название колонки df, содержащей компоненту скорости w.
+        Default: 'w'.
+    logger : logging.Logger; optional
+        Если задан, записывает лог. 
+        Default: None.
+    inplace : bool; optional
+        Если False, сделает копию df, если True перезапишет df.
+        Default: False.
+        
+    Returns
+    -------
+    df_rot_comp : pandas.core.frame.DataFrame
+        Датафрейм идентичный df, содержащий развернутые компоненты скорости u, v, w.
+    angles : pd.DataFrame
+        Датафрейм, содержащий для каждого периода осреднения сектор ('sector', начало сектора [°]), 
+        углы наклона плоскости 'Alpha', 'Beta' и угол поворота вдоль среднего ветра 'Gamma'.
+
+    Из w вычитается смещение b0, затем оси поворачиваются так, чтобы ось 'z' была перпендикулярна плоскости сектора, 
+    и в каждом периоде осреднения - вокруг новой оси 'z' вдоль среднего ветра. Средняя w за период осреднения после поворота 
+    в общем случае не равна нулю. Коэффициенты находятся по средним за периоды осреднения, поэтому повторного чтения 
+    исходных данных для аппроксимации не требуется. Значения вне периодов осреднения не изменяются.
+    Периоды осреднения в секторах без коэффициентов (меньше 'min_periods' периодов, см. planar_fit) не поворачиваются, 
+    их углы - np.nan, количество таких периодов записывается в лог. Чтобы использовать для них общую плоскость, 
+    передайте df_fit.fillna(planar_fit(df_means).iloc[0]).
+    '''
+    
+    if not inplace:
+        df = df.copy()
+
+    df_bins = as_bin_index(df_bins, df, step, start, stop)
+    inside = df_bins.ids >= 0
+    ids = df_bins.ids[inside]
+
+    fit = df_fit[['b0', 'b1', 'b2']].to_numpy(dtype='float64', copy=True)
+    sectors = len(fit)
+    fitted = np.isfinite(fit).all(axis=1)
+    fit[~fitted] = 0
+
+    # средние за период осреднения по значениям, где известны все три компоненты, и сектор каждого периода
+    velocity = df[[u_name, v_name, w_name]].to_numpy(dtype='float64', copy=True)
+    mean = df_bins.mean(np.where(np.isfinite(velocity).all(axis=1)[:, None], velocity, np.nan))
+    sector = _wind_sector(mean[:, 0], mean[:, 1], sectors)
+
+    # вычитает смещение w
+    mean[:, 2] -= fit[sector, 0]
+    velocity[inside, 2] -= fit[sector, 0][ids]
+
+    # матрица наклона плоскости каждого сектора
+    norm = np.sqrt(fit[:, 1] ** 2 + fit[:, 2] ** 2 + 1)
+    p31, p32, p33 = -fit[:, 1] / norm, -fit[:, 2] / norm, 1 / norm
+    alpha = np.arcsin(p31)
+    beta = np.arctan2(-p32, p33)
+    tilt = np.zeros((sectors, 3, 3))
+    tilt[:, 0] = np.column_stack([np.cos(alpha), np.sin(alpha) * np.sin(beta), -np.sin(alpha) * np.cos(beta)])
+    tilt[:, 1] = np.column_stack([np.zeros(sectors), np.cos(beta), np.sin(beta)])
+    tilt[:, 2] = np.column_stack([p31, p32, p33])
+    tilt = tilt[sector]
+
+    # поворот вокруг новой оси 'z' вдоль среднего ветра каждого периода осреднения
+    rotated_mean = np.einsum('nij,nj->ni', tilt, mean)
+    gamma = np.arctan2(rotated_mean[:, 1], rotated_mean[:, 0])
+    matrix = _rotation_matrix(gamma, 0, 1) @ tilt
+
+    # периоды в секторах без коэффициентов плоскости остаются без поворота
+    skipped = ~fitted[sector]
+    matrix[skipped] = np.eye(3)
+    gamma[skipped] = np.nan
+
+    velocity[inside] = np.einsum('nij,nj->ni', matrix[ids], velocity[inside])
+    for i, name in enumerate([u_name, v_name, w_name]):
+        df[name] = velocity[:, i]
+
+    alpha[~fitted] = np.nan
+    beta[~fitted] = np.nan
+    angles = pd.DataFrame({'sector': df_fit.index.to_numpy()[sector], 'Alpha': alpha[sector], 'Beta': beta[sector], 'Gamma': gamma}, 
+                          index=df_bins.left)
+    
+    if logger:
+        logger.info(f'Планарная аппроксимация применена, секторов: {sectors}')
+        observed = df_bins.observed
+        if skipped[observed].any():
+            logger.warning(f'Периоды осреднения в секторах без аппроксимации оставлены без поворота: {skipped[observed].sum()}, '
+                           f'секторы: {sorted(set(df_fit.index[sector[skipped & observed]]))}')
     
     return df, angles
 
 
 
-def rotation(df, u1, u2, angles):
+def _wind_sector(u, v, sectors):
+    '''
+    Номер сектора направления ветра (откуда дует, как calculation.wind_dir) для средних компонент 'u', 'v'.
+    '''
+    direction = np.nan_to_num((180 + np.degrees(np.arctan2(u, v))) % 360)
+    return np.minimum((direction // (360 / sectors)).astype('int64'), sectors - 1)
+
+
+
+def rotation(df, u1, u2, angles, df_bins=None):
     '''
     Осуществляет поворот компонент скорости df['u1'] и df['u2'] на угол 'angles' по всем периодам осреднения.
     
@@ -580,8 +1582,13 @@ def rotation(df, u1, u2, angles):
         Название колонки 'df', содержащей первую компоненту скорости.
     u2 : str
         Название колонки 'df', содержащей вторую компоненту скорости.
-    angles : pd.Series
-        Временная серия со значениями углов поворота для каждого интервала осреднения. 
+    angles : pd.Series, np.ndarray or float
+        Значения углов поворота для каждого интервала осреднения 'df_bins'. 
+    df_bins : BinIndex or pandas.core.arrays.categorical.Categorical; optional
+        Объект, содержащий границы интервалов осреднения (см. create_bins). Если не задан и 'angles' - pd.Series 
+        с индексом интервалов (прежний формат, результат groupby по pd.cut), значения относятся к интервалам по индексу 'angles', 
+        иначе все значения 'df' поворачиваются на один угол 'angles'.
+        Default: None.
     
     Returns
     -------
@@ -589,15 +1596,29 @@ def rotation(df, u1, u2, angles):
     Объект идентичный входному 'df', содержащий развернутые компоненты скорости 'u1', 'u2'.
     '''
     
-    sin = np.sin(angles)
-    cos = np.cos(angles)
-
-    U1 = df[u1].copy()
-    U2 = df[u2].copy()
-
-    for ind in angles.index:
-        df.loc[ind.left:ind.right, u1] = U1.loc[ind.left:ind.right] * cos[ind] + U2.loc[ind.left:ind.right] * sin[ind]
-        df.loc[ind.left:ind.right, u2] = -U1.loc[ind.left:ind.right] * sin[ind] + U2.loc[ind.left:ind.right] * cos[ind]
+    if df_bins is not None:
+        ids = as_bin_index(df_bins).ids
+    elif isinstance(getattr(angles, 'index', None), pd.IntervalIndex):
+        ids = angles.index.get_indexer(df.index)
+    else:
+        ids = np.zeros(len(df), dtype='int32')
+
+    sin = np.sin(np.atleast_1d(np.asarray(angles, dtype='float64')))
+    cos = np.cos(np.atleast_1d(np.asarray(angles, dtype='float64')))
+
+    U1 = df[u1].to_numpy(dtype='float64', copy=True)
+    U2 = df[u2].to_numpy(dtype='float64', copy=True)
+    V1 = U1.copy()
+    V2 = U2.copy()
+
+    # углы разворачиваются на все значения периодов осреднения, значения вне периодов не изменяются
+    inside = ids >= 0
+    sin = sin[ids[inside]]
+    cos = cos[ids[inside]]
+    V1[inside] = U1[inside] * cos + U2[inside] * sin
+    V2[inside] = -U1[inside] * sin + U2[inside] * cos
+
+    df[u1] = V1
+    df[u2] = V2
         
     return df
-    
\ No newline at end of file
@@ -4,11 +4,13 @@ import eclib.calculation as ec
 import eclib.dataquality as dq
 from datetime import timedelta
 import pandas as pd
+import numpy as np
+import json
 import os
 
 
 
-def processing(df, avg_period, start, stop, output_path = '.', inplace = False):
+def processing(df, avg_period, start, stop, output_path = '.', inplace = False, return_quality = False):
 
     start = pd.to_datetime(start)
     stop = pd.to_datetime(stop)
@@ -24,52 +26,61 @@ def processing(df, avg_period, start, stop, output_path = '.', inplace = False):
 
     counts_before_processing = dq.counts(df, df_bins)
     
-    pp.absolute_limits_filtration(df1.t, ulim = 40, blim = -40, inplace = True)
-    pp.absolute_limits_filtration(df1.u, ulim = 30, blim = -30, inplace = True)
-    pp.absolute_limits_filtration(df1.v, ulim = 30, blim = -30, inplace = True)
-    pp.absolute_limits_filtration(df1.w, ulim = 5 , blim = -5 , inplace = True)
+    df1['t'] = pp.absolute_limits_filtration(df1.t, ulim = 40, blim = -40)
+    df1['u'] = pp.absolute_limits_filtration(df1.u, ulim = 30, blim = -30)
+    df1['v'] = pp.absolute_limits_filtration(df1.v, ulim = 30, blim = -30)
+    df1['w'] = pp.absolute_limits_filtration(df1.w, ulim = 5 , blim = -5 )
 
-    pp.gates_filtration(df1.t, limit = 5 , df_bins = df_bins, inplace = True)
-    pp.gates_filtration(df1.u, limit = 20, df_bins = df_bins, inplace = True)
-    pp.gates_filtration(df1.v, limit = 20, df_bins = df_bins, inplace = True)
-    pp.gates_filtration(df1.w, limit = 5 , df_bins = df_bins, inplace = True)
+    pp.gates_filtration(df1, limit = {'t': 5, 'u': 20, 'v': 20, 'w': 5}, df_bins = df_bins, inplace = True)
 
     pp.detrend(df1, df_bins, mode = 'dwm', inplace = True)
 
-    pp.sigmas_filtration(df1.t, nsig = 3.5, n = 20, iterations = 10, df_bins = df_bins, inplace = True)
-    pp.sigmas_filtration(df1.u, nsig = 3.5, n = 20, iterations = 10, df_bins = df_bins, inplace = True)
-    pp.sigmas_filtration(df1.v, nsig = 3.5, n = 20, iterations = 10, df_bins = df_bins, inplace = True)
-    pp.sigmas_filtration(df1.w, nsig = 5  , n = 20, iterations = 10, df_bins = df_bins, inplace = True)
+    df1['t'] = pp.sigmas_filtration(df1.t, nsig = 3.5, n = 20, iterations = 10, df_bins = df_bins)
+    df1['u'] = pp.sigmas_filtration(df1.u, nsig = 3.5, n = 20, iterations = 10, df_bins = df_bins)
+    df1['v'] = pp.sigmas_filtration(df1.v, nsig = 3.5, n = 20, iterations = 10, df_bins = df_bins)
+    df1['w'] = pp.sigmas_filtration(df1.w, nsig = 5  , n = 20, iterations = 10, df_bins = df_bins)
 
-    counts_before_gapfilling = dq.counts(df1, df_bins)
-    pp.fillgaps(df1, inplace = True)
-    counts_after_gapfilling = dq.counts(df1, df_bins)
+    _, counts_before_gapfilling, counts_after_gapfilling = pp.fillgaps(df1, df_bins = df_bins, inplace = True, return_counts = True)
 
     bad_angles_counts, _ = dq.angle_of_attack_counts(df1, df_bins, minaa = -30, maxaa = 30)
 
+    # средние компоненты скорости до поворота осей (для pp.planar_fit)
+    unrotated_means = ec.means(df1[['u', 'v', 'w']], df_bins).add_suffix('_unrot')
+
     _, angles_of_rotations = pp.axis_rotations(df1, D = 2, df_bins = df_bins, inplace = True)
 
     data_availability_flags = (counts_before_gapfilling / counts_before_processing * 100) < 80
     
     bad_angles_flags = (bad_angles_counts / counts_after_gapfilling.w * 100) > 10
 
-    skew = dq.skewness(df1, df_bins)
+    df1_stats = dq.statistics(df1, df_bins, stats = ['skew', 'kurt'])
+
+    skew = df1_stats['skew']
     skew_flags = (skew < -2) | (skew > 2)
     
-    kurt = dq.kurtosis(df1, df_bins)
+    kurt = df1_stats['kurt']
     kurt_flags = kurt > 8
 
     hard_flags = (data_availability_flags + skew_flags + kurt_flags)
     hard_flags[['u','v','w']] = hard_flags[['u','v','w']].add(bad_angles_flags, axis=0)
 
+    quality = {
+        'counts_before_processing': counts_before_processing,
+        'counts_before_gapfilling': counts_before_gapfilling,
+        'counts_after_gapfilling': counts_after_gapfilling,
+        'bad_angles_counts': bad_angles_counts,
+        'skewness': skew,
+        'kurtosis': kurt,
+        'hard_flags': hard_flags,
+        'unrotated_means': unrotated_means,
+    }
+
     if output_path:
-        counts_before_processing.to_csv(f'{output_path}/{start.date()}-{stop.date()}_counts_before_processing_{avg_period}min.csv')
-        counts_before_gapfilling.to_csv(f'{output_path}/{start.date()}-{stop.date()}_counts_before_gapfilling_{avg_period}min.csv')
-        counts_after_gapfilling.to_csv(f'{output_path}/{start.date()}-{stop.date()}_counts_after_gapfilling_{avg_period}min.csv')
-        bad_angles_counts.to_csv(f'{output_path}/{start.date()}-{stop.date()}_bad_angles_counts_{avg_period}min.csv')
-        skew.to_csv(f'{output_path}/{start.date()}-{stop.date()}_skewness_{avg_period}min.csv')
-        kurt.to_csv(f'{output_path}/{start.date()}-{stop.date()}_kurtosis_{avg_period}min.csv')
-        hard_flags.to_csv(f'{output_path}/{start.date()}-{stop.date()}_hard_flags_{avg_period}min.csv')
+        for name, table in quality.items():
+            table.to_csv(f'{output_path}/{start.date()}-{stop.date()}_{name}_{avg_period}min.csv')
+
+    if return_quality:
+        return df1, quality
     
     return df1
 
@@ -93,35 +104,10 @@ def calculation(df, avg_period, start, stop, output_path = '.', inplace = False)
 
     ec.pulsations(df1, df_bins, df_means=df1_means, inplace=True)
 
-    df1_means['uu']     = ec.stat_moments(df1[['u']*2], df_bins)
-    df1_means['vv']     = ec.stat_moments(df1[['v']*2], df_bins)
-    df1_means['ww']     = ec.stat_moments(df1[['w']*2], df_bins)
-    df1_means['tt']     = ec.stat_moments(df1[['t']*2], df_bins)
-    df1_means['wu']     = ec.stat_moments(df1[['w','u']], df_bins)
-    df1_means['wv']     = ec.stat_moments(df1[['w','v']], df_bins)
-    df1_means['wt']     = ec.stat_moments(df1[['w','t']], df_bins)
-    df1_means['wu_h']   = (df1_means.wu ** 2 + df1_means.wv ** 2) ** 0.5
-    
-    P = 101325  # [Pa]
-    R = 287 # [J/(kg·K)]
-    rho = P / (R * (df1_means.t + 273.15))  # [kg/m3]
-    Cp = 1005  # [J/(kg·K)]
-    
-    df1_means['H']      = rho * Cp * df1_means.wt  # [W/m2]
-    df1_means['tau']    = rho * df1_means.wu_h  # [N/m2]
-   
-    df1_means['u_star'] = df1_means.wu_h ** 0.5
-    df1_means['L']      = -(df1_means.t + 273.15) * df1_means.u_star ** 3 / ( 9.8 * 0.4 * df1_means.wt) 
-    df1_means['TKE']    = (df1_means.uu + df1_means.vv + df1_means.ww) / 2
-    df1_means['A']      = df1_means.ww / (df1_means.uu + df1_means.vv + df1_means.ww) 
-    df1_means['wuu']    = ec.stat_moments(df1[['w','u','u']], df_bins)
-    df1_means['wvv']    = ec.stat_moments(df1[['w','v','v']], df_bins)
-    df1_means['wtt']    = ec.stat_moments(df1[['w','t','t']], df_bins)
-    df1_means['wwt']    = ec.stat_moments(df1[['w','w','t']], df_bins)
-    df1_means['uuu']    = ec.stat_moments(df1[['u']*3], df_bins)
-    df1_means['vvv']    = ec.stat_moments(df1[['v']*3], df_bins)
-    df1_means['www']    = ec.stat_moments(df1[['w']*3], df_bins)
-    df1_means['ttt']    = ec.stat_moments(df1[['t']*3], df_bins)
+    df1_moments = ec.co_moments(df1, df_bins, moments = ec.SECOND_MOMENTS + ec.THIRD_MOMENTS)
+    df1_means[ec.SECOND_MOMENTS] = df1_moments[ec.SECOND_MOMENTS]
+    ec.fluxes(df1_means)
+    df1_means[ec.THIRD_MOMENTS] = df1_moments[ec.THIRD_MOMENTS]
 
     if output_path:
         df1_means.to_csv(f'{output_path}/{start.date()}-{stop.date()}_moments_{avg_period}min.csv')
@@ -130,6 +116,117 @@ def calculation(df, avg_period, start, stop, output_path = '.', inplace = False)
 
 
 
+def incremental(files_pattern, avg_period, state_path, output_path = '.', func = dr.nc_to_df, info_func = dr.nc_info, 
+                variables = ('temp', 'u', 'v', 'w'), cache_dir = None, logger = None):
+    '''
+    Обрабатывает только периоды осреднения, затронутые новыми или измененными файлами, и дописывает их в выходные таблицы.
+
+    Состояние хранится в json файле 'state_path': последний завершенный период осреднения и размер/время модификации 
+    уже обработанных файлов. Каталог файлов хранится рядом с состоянием (см. dr.update_catalog).
+    Пересчитываются периоды, которые пересекаются с новыми или измененными файлами, и все завершенные периоды после 
+    последнего обработанного. Незавершенный последний период (данные за ним еще не пришли) откладывается до следующего запуска.
+    Строки моментов и таблиц качества пишутся в '{output_path}/{name}_{avg_period}min.csv': новые строки дописываются 
+    в конец файла, пересчитанные строки заменяют старые.
+    Возвращает таблицу моментов за пересчитанные периоды или None, если пересчитывать нечего.
+    '''
+
+    step = timedelta(minutes=avg_period)
+
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    else:
+        state = {'last_bin': None, 'files': {}}
+
+    catalog_path = f'{os.path.splitext(state_path)[0]}_catalog.csv'
+    catalog = dr.update_catalog(files_pattern, catalog_path, info_func, logger)
+    if catalog.empty:
+        return
+
+    fingerprints = {path: [int(size), int(mtime)] for path, size, mtime in zip(catalog.path, catalog['size'], catalog.mtime)}
+    changed = catalog[[state['files'].get(path) != fingerprints[path] for path in catalog.path]]
+
+    # завершенным считается период, после правой границы которого уже есть данные
+    data_end = catalog['last'].max()
+    sample = pd.Timedelta(seconds=1 / np.nanmax(catalog.frequency)) if catalog.frequency.notna().any() else pd.Timedelta(0)
+    last_complete = (data_end + sample).floor(step) - step
+
+    bins = set()
+    for first, last in zip(changed['first'], changed['last']):
+        bins.update(pd.date_range(first.floor(step), last.floor(step), freq=step))
+    if state['last_bin'] is not None:
+        bins.update(pd.date_range(pd.to_datetime(state['last_bin']) + step, last_complete, freq=step))
+    else:
+        bins.update(pd.date_range(catalog['first'].min().floor(step), last_complete, freq=step))
+    bins = sorted(b for b in bins if b <= last_complete)
+
+    if not bins:
+        if logger:
+            logger.info('Нет новых завершенных периодов осреднения')
+        return
+
+    # непрерывные диапазоны пересчитываемых периодов
+    bins = pd.DatetimeIndex(bins)
+    breaks = np.flatnonzero(np.diff(bins) != step) + 1
+    ranges = [(chunk[0], chunk[-1] + step) for chunk in np.split(bins, breaks)]
+
+    moments = []
+    tables = {}
+    for start, stop in ranges:
+        if logger:
+            logger.info(f'Пересчет периодов с {start} по {stop}')
+        df = dr.read_all_files(func, files_pattern, logger, start = start, stop = stop, variables = variables, 
+                               catalog = catalog_path, cache_dir = cache_dir, info_func = info_func)
+        if df.empty:
+            continue
+        df = df[df.index < stop].rename(columns = {'temp': 't'})
+        df1, quality = processing(df, avg_period, start, stop, output_path = None, inplace = True, return_quality = True)
+        moments.append(calculation(df1, avg_period, start, stop, output_path = None, inplace = True))
+        for name, table in quality.items():
+            tables.setdefault(name, []).append(table)
+
+    if not moments:
+        return
+
+    moments = pd.concat(moments)
+    tables = {'moments': moments} | {name: pd.concat(table) for name, table in tables.items()}
+
+    last_bin = pd.to_datetime(state['last_bin']) if state['last_bin'] else None
+
+    if output_path:
+        for name, table in tables.items():
+            append_rows(table, f'{output_path}/{name}_{avg_period}min.csv', last_bin)
+
+    state = {'last_bin': str(bins[-1] if last_bin is None else max(bins[-1], last_bin)), 'files': fingerprints}
+    with open(f'{state_path}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'{state_path}.tmp', state_path)
+
+    return moments
+
+
+
+def append_rows(table, path, last_bin = None):
+    '''
+    Дописывает строки 'table' в csv файл 'path'. Строки с уже записанными индексами заменяются.
+    Если все строки 'table' позже 'last_bin' (последней записанной строки), файл не перечитывается.
+    '''
+
+    table = table.set_axis(pd.DatetimeIndex(np.asarray(table.index)))
+
+    if not os.path.exists(path):
+        table.to_csv(path)
+        return
+
+    if last_bin is not None and table.index.min() > last_bin:
+        table.to_csv(path, mode = 'a', header = False)
+    else:
+        old = pd.read_csv(path, index_col = 0, parse_dates = True)
+        old = old[~old.index.isin(table.index)]
+        pd.concat([old, table]).sort_index().to_csv(path)
+
+
+
 if __name__ == '__main__':
 
     input_data = './test_data/msu/01/MSU_A1_*.nc'
@@ -142,7 +239,7 @@ if __name__ == '__main__':
         os.makedirs(output_path)
         
     print('Data reading...')
-    df = dr.read_all_files(func=dr.nc_to_df, files_pattern=input_data)
+    df = dr.read_all_files(func=dr.nc_to_df, files_pattern=input_data, start=start, stop=stop, variables=['temp', 'u', 'v', 'w'])
     df.rename(columns={'temp': 't'}, inplace=True)
 
     print('Data processing...')
@@ -7,6 +7,7 @@ import eclib.dataquality as dq
 import eclib.preprocessing as pp
 import eclib.calculation as ec
 import eclib.dataplot as dp
+from eclib.cache import clean_cache
 
 import logging
 from datetime import datetime, timezone, timedelta
@@ -52,6 +53,7 @@ show = False  # Вывод промежуточной визуализации
 output_plot = True  # Отрисовка выходных переменных
 output_show = False  # Вывод визуализации выходных переменных
 console_log = True  # Дублирование лога в консоль
+cache_dir = f'{output_path}/cache'  # Папка кэша декодированных исходных данных, None - без кэша
 
 step = timedelta(minutes=avg_period) 
 stop += timedelta(microseconds=1)
@@ -78,6 +80,9 @@ nsig_w = 5  # Размер допустимого отклонения от ср
 n = friquency  # Длина превышения, после которой превышение считается значимым
 iterations = 10  # Количество итераций при удалении пиков
 
+# ==================== Заполнение пропусков ==================== 
+max_gap = friquency  # Максимальная длина заполняемого пропуска (количество значений), более длинные пропуски не заполняются
+
 # ==================== Поворот осей координат ====================
 D = 2  # Количество поворотов осей
 
@@ -128,7 +133,10 @@ logger.info('НАЧАЛО ОБРАБОТКИ')
 logger.info('Считывание данных')
 # ============================================================
 
-df = dr.read_all_files(func = dr.nc_to_df, files_pattern = input_data, logger = logger)
+if cache_dir:
+    clean_cache(cache_dir, logger)
+
+df = dr.read_all_files(func = dr.nc_to_df, files_pattern = input_data, logger = logger, start = start, stop = stop, variables = ['temp','u','v','w'], cache_dir = cache_dir)
 df.rename(columns = {'temp': 't'}, inplace = True)
 df = df[['t','u','v','w']]
 
@@ -187,10 +195,8 @@ df1 = pd.DataFrame({
 logger.info("Фильтрация 'воротами'")
 # ============================================================
 
-pp.gates_filtration(t, limit_t, df_bins, logger = logger, inplace = True)
-pp.gates_filtration(u, limit_u, df_bins, logger = logger, inplace = True)
-pp.gates_filtration(v, limit_v, df_bins, logger = logger, inplace = True)
-pp.gates_filtration(w, limit_w, df_bins, logger = logger, inplace = True)
+gates = pp.gates_filtration(df1, {'t': limit_t, 'u': limit_u, 'v': limit_v, 'w': limit_w}, df_bins, logger = logger)
+t, u, v, w = gates.t, gates.u, gates.v, gates.w
 
 if plot:
     title = 'Фильтрация "воротами"'
@@ -273,9 +279,7 @@ df1 = pd.DataFrame({
 logger.info("Заполнение пропусков")
 # ============================================================
 
-counts_before_gapfilling = dq.counts(df1, df_bins)
-pp.fillgaps(df1, inplace = True)
-counts_after_gapfilling = dq.counts(df1, df_bins)
+_, counts_before_gapfilling, counts_after_gapfilling = pp.fillgaps(df1, max_gap = max_gap, df_bins = df_bins, logger = logger, inplace = True, return_counts = True)
 
 # ============================================================
 logger.info("Расчет угла атаки")
@@ -316,10 +320,12 @@ data_availability_flags = data_availability < min_data_availability
 bad_angles_percent = bad_angles_counts / counts_after_gapfilling.w * 100
 bad_angles_flags = bad_angles_percent > aaoo
 
-skew = dq.skewness(df1_rot, df_bins)
+df1_rot_stats = dq.statistics(df1_rot, df_bins, stats = ['skew', 'kurt'])
+
+skew = df1_rot_stats['skew']
 skew_flags = (skew < bhl_sk) | (skew > uhl_sk)
 
-kurt = dq.kurtosis(df1_rot, df_bins)
+kurt = df1_rot_stats['kurt']
 kurt_flags = kurt > uhl_kr
 
 hard_flags = (data_availability_flags + skew_flags + kurt_flags)
@@ -385,27 +391,18 @@ logger.info("Расчет пульсаций и моментов")
 
 ec.pulsations(df1_rot, df_bins, inplace=True)
 
-df1_rot_means['uu']     = ec.stat_moments(df1_rot[['u']*2], df_bins)
-df1_rot_means['vv']     = ec.stat_moments(df1_rot[['v']*2], df_bins)
-df1_rot_means['ww']     = ec.stat_moments(df1_rot[['w']*2], df_bins)
-df1_rot_means['tt']     = ec.stat_moments(df1_rot[['t']*2], df_bins)
-df1_rot_means['wu']     = ec.stat_moments(df1_rot[['w','u']], df_bins)
-df1_rot_means['wv']     = ec.stat_moments(df1_rot[['w','v']], df_bins)
-df1_rot_means['wt']     = ec.stat_moments(df1_rot[['w','t']], df_bins)
+df1_rot_moments = ec.co_moments(df1_rot, df_bins, moments = ec.SECOND_MOMENTS + ec.THIRD_MOMENTS)
+df1_rot_means[ec.SECOND_MOMENTS] = df1_rot_moments[ec.SECOND_MOMENTS]
 df1_rot_means['wu_h']   = (df1_rot_means.wu ** 2 + df1_rot_means.wv ** 2) ** 0.5
 df1_rot_means['u_star'] = df1_rot_means.wu_h ** 0.5
 df1_rot_means['L']      = -(df1_rot_means.t + 273.15) * df1_rot_means.u_star ** 3 / ( 9.8 * 0.4 * df1_rot_means.wt) 
 df1_rot_means['zeta']   = z / df1_rot_means.L
 df1_rot_means['TKE']    = (df1_rot_means.uu + df1_rot_means.vv + df1_rot_means.ww) / 2
 df1_rot_means['A']      = df1_rot_means.ww / (df1_rot_means.uu + df1_rot_means.vv + df1_rot_means.ww)
-df1_rot_means['wuu']    = ec.stat_moments(df1_rot[['w','u','u']], df_bins)
-df1_rot_means['wvv']    = ec.stat_moments(df1_rot[['w','v','v']], df_bins)
-df1_rot_means['wtt']    = ec.stat_moments(df1_rot[['w','t','t']], df_bins)
-df1_rot_means['wwt']    = ec.stat_moments(df1_rot[['w','w','t']], df_bins)
-df1_rot_means['uuu']    = ec.stat_moments(df1_rot[['u']*3], df_bins)
-df1_rot_means['vvv']    = ec.stat_moments(df1_rot[['v']*3], df_bins)
-df1_rot_means['www']    = ec.stat_moments(df1_rot[['w']*3], df_bins)
-df1_rot_means['ttt']    = ec.stat_moments(df1_rot[['t']*3], df_bins)
+df1_rot_means[ec.THIRD_MOMENTS] = df1_rot_moments[ec.THIRD_MOMENTS]
+
+# средние компоненты скорости до поворота осей (для pp.planar_fit)
+df1_rot_means[['u_unrot', 'v_unrot', 'w_unrot']] = df1_means[['u', 'v', 'w']]
 
 df1_rot_means.to_csv(f'{output_path}/output/{start.date()}-{stop.date()}_moments_{avg_period}min.csv')
 